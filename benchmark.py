@@ -0,0 +1,874 @@
+# -*- coding: utf-8 -*-
+# Offline benchmark for easy_run.py. Runs the phases of main() against local
+# stand-ins for the Canvas and Todoist APIs filled with synthetic data, and reports
+# wall time, request count and peak memory for every phase.
+#
+#   python benchmark.py --assignments 5000 --tasks 10000 --output after.json
+#   python benchmark.py --compare before.json after.json
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import todoist_api_python._core.endpoints as todoist_endpoints
+
+import easy_run
+
+timestamp = "2026-01-05T12:00:00Z"  # created_at/updated_at of generated Todoist objects
+todoist_page_size = 50  # Default page size of the Todoist REST API
+canvas_max_page_size = 100  # Canvas caps per_page at 100
+task_label = "canvas"  # Label of synced tasks, used by --scope label
+
+
+# Synthetic Canvas and Todoist account. Holds the courses and assignments served by the
+# Canvas stand-in and the projects and tasks served by the Todoist stand-in
+class Dataset:
+    def __init__(self, assignments, tasks, courses, seed):
+        rng = random.Random(seed)
+        self.courses = [
+            {"id": 1000 + i, "name": f"BENCH {101 + i} Section {i % 3 + 1}"}
+            for i in range(courses)
+        ]
+        self.assignments = {course["id"]: [] for course in self.courses}
+        for i in range(assignments):
+            course = self.courses[i % courses]
+            self.assignments[course["id"]].append(generate_assignment(rng, course, i))
+        self.ids = itertools.count(1)
+        self.projects = {}
+        self.tasks = {}
+        self.lock = threading.Lock()
+        # Change counter for Sync API reads: object id: version of its last change
+        self.versions = {}
+        self.version = 0
+        inbox = self.add_project("Inbox")
+        project_ids = {}
+        # Tasks for already synced assignments come first, then unrelated personal tasks
+        synced = [
+            assignment
+            for course_assignments in self.assignments.values()
+            for assignment in course_assignments
+            if assignment["submission"]["workflow_state"] == "unsubmitted"
+        ]
+        for i in range(tasks):
+            if i < len(synced) // 2:
+                assignment = synced[i]
+                course_name = self.course_name(assignment["course_id"])
+                if course_name not in project_ids:
+                    project_ids[course_name] = self.add_project(course_name)
+                due_at = assignment["due_at"]
+                self.add_task(
+                    f"[{assignment['name']}]({assignment['html_url']}) Due",
+                    project_ids[course_name],
+                    due_json(todoist_due_format(due_at, i)),
+                    due_json(due_at and due_at[:10]),
+                    labels=[task_label],
+                )
+            else:
+                self.add_task(f"Personal task {i}", inbox, None)
+
+    # Course names as easy_run.py turns them into project names
+    def course_name(self, course_id):
+        name = next(c["name"] for c in self.courses if c["id"] == course_id)
+        return re.sub(r"[^-a-zA-Z0-9._\s]", "", name)
+
+    def next_id(self):
+        with self.lock:
+            return str(next(self.ids))
+
+    def touch(self, object_id):
+        with self.lock:
+            self.version += 1
+            self.versions[object_id] = self.version
+
+    def add_project(self, name):
+        project_id = self.next_id()
+        self.projects[project_id] = project_json(project_id, name)
+        self.touch(project_id)
+        return project_id
+
+    def add_task(self, content, project_id, due, deadline=None, labels=()):
+        task_id = self.next_id()
+        self.tasks[task_id] = task_json(
+            task_id, content, project_id, due, deadline, labels
+        )
+        self.touch(task_id)
+        return task_id
+
+
+def generate_assignment(rng, course, i):
+    due_at = None
+    if rng.random() < 0.85:
+        due_at = f"2026-{rng.randint(1, 5):02d}-{rng.randint(1, 28):02d}T05:59:00Z"
+    workflow_state = rng.choice(["unsubmitted"] * 3 + ["submitted", "graded"])
+    return {
+        "id": 500000 + i,
+        "course_id": course["id"],
+        "name": f"Assignment {i}: {rng.choice(['Essay', 'Quiz', 'Lab', 'Reading'])}",
+        "html_url": f"https://canvas.example.edu/courses/{course['id']}/assignments/{500000 + i}",
+        "description": "<p>"
+        + "Lorem ipsum dolor sit amet. " * rng.randint(5, 40)
+        + "</p>",
+        "due_at": due_at,
+        "unlock_at": None,
+        "lock_at": None,
+        "locked_for_user": rng.random() < 0.05,
+        "lock_explanation": "",
+        "points_possible": rng.choice([10, 20, 50, 100]),
+        "submission_types": [
+            rng.choice(["online_upload", "online_text_entry", "none", "on_paper"])
+        ],
+        "graded_submissions_exist": workflow_state == "graded",
+        "rubric": [
+            {"id": f"r{k}", "points": 5, "description": "Criterion"} for k in range(3)
+        ],
+        "submission": {
+            "workflow_state": workflow_state,
+            "graded_at": timestamp if workflow_state == "graded" else None,
+            "score": None,
+        },
+    }
+
+
+# Moves the due dates of n random assignments a day later, or gives them one, and
+# returns the Canvas Live Events sent for the changes. Ids are global ids of shard 1
+def change_assignments(dataset, rng, n):
+    assignments = [
+        assignment
+        for course_assignments in dataset.assignments.values()
+        for assignment in course_assignments
+    ]
+    payloads = []
+    for assignment in rng.sample(assignments, min(n, len(assignments))):
+        due = datetime.fromisoformat(
+            (assignment["due_at"] or "2026-05-01T05:59:00Z").replace("Z", "+00:00")
+        )
+        assignment["due_at"] = (due + timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        context = {
+            "context_type": "Course",
+            "context_id": str(10**13 + assignment["course_id"]),
+        }
+        payloads.append(
+            {
+                "metadata": dict(context, event_name="assignment_updated"),
+                "body": dict(
+                    context,
+                    assignment_id=str(10**13 + assignment["id"]),
+                    title=assignment["name"],
+                    due_at=assignment["due_at"],
+                ),
+            }
+        )
+    return payloads
+
+
+def project_json(project_id, name):
+    return {
+        "id": project_id,
+        "name": name,
+        "description": "",
+        "child_order": 1,
+        "color": "charcoal",
+        "collapsed": False,
+        "shared": False,
+        "is_favorite": False,
+        "is_archived": False,
+        "can_assign_tasks": False,
+        "view_style": "list",
+        "created_at": timestamp,
+        "updated_at": timestamp,
+        "inbox_project": name == "Inbox",
+    }
+
+
+def task_json(task_id, content, project_id, due, deadline=None, labels=()):
+    return {
+        "id": task_id,
+        "content": content,
+        "description": "",
+        "project_id": project_id,
+        "section_id": None,
+        "parent_id": None,
+        "labels": list(labels),
+        "priority": 1,
+        "due": due,
+        "deadline": deadline,
+        "duration": None,
+        "collapsed": False,
+        "child_order": 1,
+        "responsible_uid": None,
+        "assigned_by_uid": None,
+        "completed_at": None,
+        "added_by_uid": "1",
+        "added_at": timestamp,
+        "updated_at": timestamp,
+    }
+
+
+# The due date of an already synced task in one of the formats Todoist may return for
+# the assignment's due date: unchanged, with an offset, or as an all-day date
+def todoist_due_format(due_at, i):
+    if due_at is None:
+        return None
+    if i % 3 == 1:
+        due = datetime.fromisoformat(due_at.replace("Z", "+00:00"))
+        return due.astimezone(timezone(timedelta(hours=-5))).isoformat()
+    if i % 3 == 2:
+        return due_at[:10]
+    return due_at
+
+
+# Converts the due/deadline arguments of a REST or Sync API write into a Todoist due object
+def due_json(date):
+    if date is None:
+        return None
+    return {"date": date, "string": date, "lang": "en", "is_recurring": False}
+
+
+# HTTP stand-in for both APIs. Counts every request by endpoint, adds the configured
+# latency to each response and answers the configured share of requests with 429
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = (
+        "HTTP/1.1"  # Keep-alive, so pooled sessions behave as in production
+    )
+    dataset = None
+    latency = 0.0
+    rate_limit_rate = 0.0
+    retry_after = 0
+    requests = Counter()
+    requests_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        endpoint = f"{method} {re.sub(r'/[0-9]+', '/{id}', url.path)}"
+        with self.requests_lock:
+            self.requests[endpoint] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.rate_limit_rate and random.random() < self.rate_limit_rate:
+            with self.requests_lock:
+                self.requests["429"] += 1
+            return self.send_json(
+                429, {"error": "Too Many Requests"}, {"Retry-After": self.retry_after}
+            )
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        route = ROUTES.get((method, re.sub(r"/[0-9]+", "/{id}", url.path)))
+        if route is None:
+            return self.send_json(404, {"error": "Not Found"})
+        route(self, url.path, query, body)
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def base_url(self):
+        return f"http://{self.headers['Host']}"
+
+    # Canvas GET responses carry an ETag and are answered with 304 Not Modified when the
+    # client already has them
+    def send_cacheable(self, payload, headers=None):
+        etag = f'W/"{hashlib.md5(json.dumps(payload).encode("utf-8")).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_json(200, payload, dict(headers or {}, ETag=etag))
+
+
+def canvas_courses(handler, path, query, body):
+    handler.send_cacheable(handler.dataset.courses)
+
+
+# Serves a page of course assignments with Canvas style Link headers
+def canvas_assignments(handler, path, query, body):
+    course_id = int(path.split("/")[4])
+    assignments = handler.dataset.assignments.get(course_id)
+    if assignments is None:
+        return handler.send_json(404, {"errors": [{"message": "not found"}]})
+    per_page = min(int(query.get("per_page", 10)), canvas_max_page_size)
+    page = int(query.get("page", 1))
+    last = max(1, -(-len(assignments) // per_page))
+    links = []
+    for rel, number in (
+        ("current", page),
+        ("next", page + 1),
+        ("first", 1),
+        ("last", last),
+    ):
+        if rel == "next" and page >= last:
+            continue
+        link_query = urlencode(dict(query, page=number, per_page=per_page))
+        links.append(f'<{handler.base_url()}{path}?{link_query}>; rel="{rel}"')
+    handler.send_cacheable(
+        assignments[(page - 1) * per_page : page * per_page],
+        {"Link": ",".join(links), "X-Rate-Limit-Remaining": "700.0"},
+    )
+
+
+def canvas_assignment(handler, path, query, body):
+    course_id, assignment_id = int(path.split("/")[4]), int(path.split("/")[6])
+    for assignment in handler.dataset.assignments.get(course_id, ()):
+        if assignment["id"] == assignment_id:
+            return handler.send_cacheable(
+                assignment, {"X-Rate-Limit-Remaining": "700.0"}
+            )
+    handler.send_json(404, {"errors": [{"message": "not found"}]})
+
+
+# Answers the assignment query of easy_run.py's GraphQL backend. Only the parts of the
+# query that easy_run.py varies are parsed: the course aliases, page size and cursors
+def canvas_graphql(handler, path, query, body):
+    request = json.loads(body or b"{}")
+    text, variables = request["query"], request.get("variables") or {}
+    page_size = int(re.search(r"first: (\d+)", text).group(1))
+    data = {}
+    for alias, course_id, cursor in re.findall(
+        r'(\w+): course\(id: "(\d+)"\)[^$]*\$(\w+)', text
+    ):
+        assignments = handler.dataset.assignments.get(int(course_id))
+        if assignments is None:
+            data[alias] = None
+            continue
+        start = int(variables.get(cursor) or 0)
+        end = start + page_size
+        name = next(
+            c["name"] for c in handler.dataset.courses if c["id"] == int(course_id)
+        )
+        data[alias] = {
+            "name": name,
+            "assignmentsConnection": {
+                "nodes": [graphql_node(a) for a in assignments[start:end]],
+                "pageInfo": {
+                    "hasNextPage": end < len(assignments),
+                    "endCursor": str(end),
+                },
+            },
+        }
+    handler.send_json(200, {"data": data})
+
+
+def graphql_node(assignment):
+    submission = assignment["submission"]
+    return {
+        "_id": str(assignment["id"]),
+        "name": assignment["name"],
+        "htmlUrl": assignment["html_url"],
+        "dueAt": assignment["due_at"],
+        "unlockAt": assignment["unlock_at"],
+        "lockInfo": {"isLocked": assignment["locked_for_user"]},
+        "submissionTypes": assignment["submission_types"],
+        "gradedSubmissionsExist": assignment["graded_submissions_exist"],
+        "submissionsConnection": {
+            "nodes": [
+                {
+                    "state": submission["workflow_state"],
+                    "gradedAt": submission["graded_at"],
+                }
+            ]
+        },
+    }
+
+
+# Serves a cursor paginated Todoist REST list
+def todoist_list(handler, items, query):
+    limit = int(query.get("limit", todoist_page_size))
+    start = int(query.get("cursor") or 0)
+    results = items[start : start + limit]
+    next_cursor = str(start + limit) if start + limit < len(items) else None
+    handler.send_json(200, {"results": results, "next_cursor": next_cursor})
+
+
+def todoist_projects(handler, path, query, body):
+    todoist_list(handler, list(handler.dataset.projects.values()), query)
+
+
+def todoist_tasks(handler, path, query, body):
+    tasks = list(handler.dataset.tasks.values())
+    if "project_id" in query:
+        tasks = [task for task in tasks if task["project_id"] == query["project_id"]]
+    if "label" in query:
+        tasks = [task for task in tasks if query["label"] in task["labels"]]
+    todoist_list(handler, tasks, query)
+
+
+def todoist_add_project(handler, path, query, body):
+    args = json.loads(body or b"{}")
+    project_id = handler.dataset.add_project(args["name"])
+    handler.send_json(200, handler.dataset.projects[project_id])
+
+
+def todoist_add_task(handler, path, query, body):
+    args = json.loads(body or b"{}")
+    task_id = handler.dataset.add_task(
+        args["content"],
+        args.get("project_id"),
+        due_json(args.get("due_datetime")),
+        due_json(args.get("deadline_date")),
+        args.get("labels", []),
+    )
+    handler.send_json(200, handler.dataset.tasks[task_id])
+
+
+def todoist_update_task(handler, path, query, body):
+    args = json.loads(body or b"{}")
+    task = handler.dataset.tasks.get(path.split("/")[-1])
+    if task is None:
+        return handler.send_json(404, {"error": "Task not found"})
+    if "due_datetime" in args:
+        task["due"] = due_json(args["due_datetime"])
+    if "deadline_date" in args:
+        task["deadline"] = due_json(args["deadline_date"])
+    handler.dataset.touch(task["id"])
+    handler.send_json(200, task)
+
+
+# Applies a batch of Sync API commands and reports a sync_status for every command,
+# or answers a read of the items and projects changed since a sync_token
+def todoist_sync(handler, path, query, body):
+    form = parse_qs(body.decode("utf-8"))
+    dataset = handler.dataset
+    if "sync_token" in form:
+        return todoist_sync_read(handler, form)
+    commands = json.loads(form.get("commands", ["[]"])[0])
+    sync_status = {}
+    temp_id_mapping = {}
+    for command in commands:
+        args = command.get("args", {})
+        if command["type"] == "item_add":
+            task_id = dataset.add_task(
+                args["content"],
+                args.get("project_id"),
+                due_json((args.get("due") or {}).get("date")),
+                due_json((args.get("deadline") or {}).get("date")),
+                args.get("labels", []),
+            )
+            temp_id_mapping[command["temp_id"]] = task_id
+        elif command["type"] == "item_update":
+            task = dataset.tasks.get(args.get("id"))
+            if task is None:
+                sync_status[command["uuid"]] = {
+                    "error_code": 22,
+                    "error": "Item not found",
+                }
+                continue
+            if "due" in args:
+                task["due"] = due_json((args["due"] or {}).get("date"))
+            if "deadline" in args:
+                task["deadline"] = due_json((args["deadline"] or {}).get("date"))
+            dataset.touch(task["id"])
+        sync_status[command["uuid"]] = "ok"
+    handler.send_json(
+        200,
+        {
+            "sync_status": sync_status,
+            "temp_id_mapping": temp_id_mapping,
+            "sync_token": str(dataset.version),
+        },
+    )
+
+
+def todoist_sync_read(handler, form):
+    dataset = handler.dataset
+    token = form["sync_token"][0]
+    since = 0 if token == "*" else int(token)
+    resource_types = json.loads(form.get("resource_types", ["[]"])[0])
+    result = {"sync_token": str(dataset.version), "full_sync": since == 0}
+    if "items" in resource_types:
+        result["items"] = [
+            dict(task, checked=False, is_deleted=False)
+            for task_id, task in list(dataset.tasks.items())
+            if dataset.versions[task_id] > since
+        ]
+    if "projects" in resource_types:
+        result["projects"] = [
+            dict(project, is_deleted=False)
+            for project_id, project in list(dataset.projects.items())
+            if dataset.versions[project_id] > since
+        ]
+    handler.send_json(200, result)
+
+
+ROUTES = {
+    ("GET", "/api/v1/courses"): canvas_courses,
+    ("GET", "/api/v1/courses/{id}/assignments"): canvas_assignments,
+    ("GET", "/api/v1/courses/{id}/assignments/{id}"): canvas_assignment,
+    ("POST", "/api/graphql"): canvas_graphql,
+    ("GET", "/api/v1/projects"): todoist_projects,
+    ("POST", "/api/v1/projects"): todoist_add_project,
+    ("GET", "/api/v1/tasks"): todoist_tasks,
+    ("POST", "/api/v1/tasks"): todoist_add_task,
+    ("POST", "/api/v1/tasks/{id}"): todoist_update_task,
+    ("POST", "/api/v1/sync"): todoist_sync,
+}
+
+
+# Starts the stand-in server on a free local port in a background thread
+def start_server(dataset, latency, rate_limit_rate, retry_after):
+    handler = type(
+        "BenchmarkHandler",
+        (StandInHandler,),
+        {
+            "dataset": dataset,
+            "latency": latency,
+            "rate_limit_rate": rate_limit_rate,
+            "retry_after": retry_after,
+            "requests": Counter(),
+        },
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, handler
+
+
+# Runs the phases of main() once and measures each of them
+def run_phases(ctx, handler, stream, async_engine=False):
+    phases = [
+        ("select_courses", lambda: easy_run.select_courses(ctx, interactive=False)),
+        ("load_todoist_projects", lambda: easy_run.load_todoist_projects(ctx)),
+        ("load_assignments", lambda: easy_run.load_assignments(ctx)),
+        ("load_todoist_tasks", lambda: easy_run.load_todoist_tasks(ctx)),
+        ("build_todoist_task_index", lambda: easy_run.build_todoist_task_index(ctx)),
+        ("create_todoist_projects", lambda: easy_run.create_todoist_projects(ctx)),
+        (
+            "transfer_assignments_to_todoist",
+            lambda: easy_run.transfer_assignments_to_todoist(ctx),
+        ),
+        ("canvas_assignment_stats", lambda: easy_run.canvas_assignment_stats(ctx)),
+    ]
+    if stream:
+        # Loading and transferring assignments are a single phase when streaming
+        stats = easy_run.AssignmentStats()
+        phases = [phase for phase in phases if phase[0] != "load_assignments"]
+        phases[-2:] = [
+            (
+                "stream_assignments_to_todoist",
+                lambda: easy_run.transfer_assignments_to_todoist(
+                    ctx, easy_run.stream_assignments(ctx, stats)
+                ),
+            ),
+            (
+                "canvas_assignment_stats",
+                lambda: easy_run.canvas_assignment_stats(ctx, stats),
+            ),
+        ]
+    if async_engine:
+        # The async engine overlaps the loads and the transfer, so it is one phase
+        phases = [
+            phases[0],
+            ("async_sync_cycle", lambda: asyncio.run(easy_run.async_sync_cycle(ctx))),
+        ]
+    return measure_phases(handler, phases)
+
+
+# Runs the phases of --replay for Live Events payloads once and measures each of them
+def run_event_phases(ctx, handler, payloads):
+    return measure_phases(
+        handler,
+        [
+            ("select_courses", lambda: easy_run.select_courses(ctx, interactive=False)),
+            ("load_todoist_state", lambda: easy_run.load_todoist_state(ctx)),
+            (
+                "replay_live_events",
+                lambda: easy_run.replay_live_events(ctx, payloads),
+            ),
+        ],
+    )
+
+
+def measure_phases(handler, phases):
+    results = []
+    for name, phase in phases:
+        before = Counter(handler.requests)
+        tracemalloc.reset_peak()
+        started = time.perf_counter()
+        phase()
+        seconds = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        requests = handler.requests - before
+        results.append(
+            {
+                "phase": name,
+                "seconds": round(seconds, 4),
+                "requests": sum(
+                    count for endpoint, count in requests.items() if endpoint != "429"
+                ),
+                "rate_limited": requests.get("429", 0),
+                "peak_memory_bytes": peak,
+                "requests_by_endpoint": dict(sorted(requests.items())),
+            }
+        )
+    return results
+
+
+# Creates a fresh profile pointing at the stand-ins, as a previously configured user
+def make_context(base_url, dataset, directory, args):
+    config_path = os.path.join(directory, "config.json")
+    config = {
+        "todoist_api_key": "benchmark-todoist-token",
+        "canvas_api_key": "benchmark-canvas-token",
+        "canvas_api_heading": base_url,
+        "todoist_task_priority": 1,
+        "todoist_task_labels": [task_label],
+        "sync_null_assignments": True,
+        "sync_locked_assignments": True,
+        "sync_no_due_date_assignments": True,
+        "courses": [course["id"] for course in dataset.courses],
+        "todoist_sync_url": f"{base_url}/api/v1/sync",
+        "stream_assignments": args.stream,
+        "canvas_fetch_backend": args.backend,
+        "todoist_incremental_sync": args.incremental,
+        "todoist_task_scope": args.scope,
+        "canvas_cache": not args.no_canvas_cache,
+    }
+    with open(config_path, "w") as config_file:
+        json.dump(config, config_file)
+    ctx = easy_run.SyncContext(config_path, quiet=True)
+    easy_run.initialize_api(ctx, interactive=False)
+    easy_run.open_sync_state(ctx)
+    easy_run.open_canvas_cache(ctx)
+    return ctx
+
+
+def run_benchmark(args):
+    dataset = Dataset(args.assignments, args.tasks, args.courses, args.seed)
+    server, handler = start_server(
+        dataset, args.latency, args.rate_limit_rate, args.retry_after
+    )
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    todoist_endpoints.API_URL = f"{base_url}/api/v1"
+    if args.unthrottled:
+        easy_run.canvas_rate_limit = (10**9, 1)
+        easy_run.todoist_rate_limit = (10**9, 1)
+    report = {"parameters": vars(args).copy(), "runs": []}
+    tracemalloc.start()
+    with tempfile.TemporaryDirectory() as directory:
+        for run in range(1, args.runs + 1):
+            ctx = make_context(base_url, dataset, directory, args)
+            started = time.perf_counter()
+            if args.events and run > 1:
+                payloads = change_assignments(
+                    dataset, random.Random(args.seed + run), args.events
+                )
+                started = time.perf_counter()
+                phases = run_event_phases(ctx, handler, payloads)
+            else:
+                phases = run_phases(ctx, handler, args.stream, args.async_engine)
+            report["runs"].append(
+                {
+                    "run": run,
+                    "seconds": round(time.perf_counter() - started, 4),
+                    "requests": sum(phase["requests"] for phase in phases),
+                    "peak_memory_bytes": max(
+                        phase["peak_memory_bytes"] for phase in phases
+                    ),
+                    "counts": ctx.counts,
+                    "canvas_cache": dict(ctx.metrics.canvas_cache),
+                    "phases": phases,
+                }
+            )
+            ctx.sync_state.close()
+            if ctx.canvas_cache is not None:
+                ctx.canvas_cache.close()
+    tracemalloc.stop()
+    server.shutdown()
+    del report["parameters"]["compare"]
+    del report["parameters"]["output"]
+    return report
+
+
+def print_report(report):
+    for run in report["runs"]:
+        print(
+            f"Run {run['run']}: {run['seconds']:.3f}s, {run['requests']} requests, "
+            f"peak {run['peak_memory_bytes'] / 1e6:.1f} MB, counts {run['counts']}"
+        )
+        cache = run.get("canvas_cache") or {}
+        if cache:
+            print(
+                f"  Canvas cache: {cache.get('hits', 0)} hits, {cache.get('misses', 0)} misses"
+            )
+        print(
+            f"  {'Phase':<34}{'Seconds':>10}{'Requests':>10}{'429s':>6}{'Peak MB':>10}"
+        )
+        for phase in run["phases"]:
+            print(
+                f"  {phase['phase']:<34}{phase['seconds']:>10.3f}{phase['requests']:>10}"
+                f"{phase['rate_limited']:>6}{phase['peak_memory_bytes'] / 1e6:>10.1f}"
+            )
+
+
+# Prints the change of every phase between two saved reports
+def compare_reports(before_path, after_path):
+    with open(before_path) as before_file, open(after_path) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    if before["parameters"] != after["parameters"]:
+        print("Warning: the reports were run with different parameters")
+    for before_run, after_run in zip(before["runs"], after["runs"]):
+        print(f"Run {after_run['run']}:")
+        print(f"  {'Phase':<34}{'Seconds':>18}{'Requests':>16}{'Peak MB':>18}")
+        before_phases = {phase["phase"]: phase for phase in before_run["phases"]}
+        rows = [
+            (phase["phase"], before_phases.get(phase["phase"]), phase)
+            for phase in after_run["phases"]
+        ]
+        rows.append(("total", before_run, after_run))
+        for name, old, new in rows:
+            if old is None:
+                print(f"  {name:<34}{'(new phase)':>18}")
+                continue
+            print(
+                f"  {name:<34}"
+                f"{change(old['seconds'], new['seconds'], '.3f'):>18}"
+                f"{change(old['requests'], new['requests'], 'd'):>16}"
+                f"{change(old['peak_memory_bytes'] / 1e6, new['peak_memory_bytes'] / 1e6, '.1f'):>18}"
+            )
+
+
+def change(old, new, format):
+    if old:
+        return f"{new:{format}} ({(new - old) / old:+.0%})"
+    return f"{new:{format}}"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark easy_run.py against local Canvas and Todoist stand-ins"
+    )
+    parser.add_argument(
+        "--assignments",
+        type=int,
+        default=1000,
+        help="number of Canvas assignments (default 1000)",
+    )
+    parser.add_argument(
+        "--tasks",
+        type=int,
+        default=2000,
+        help="number of existing Todoist tasks (default 2000)",
+    )
+    parser.add_argument(
+        "--courses", type=int, default=8, help="number of courses (default 8)"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=1, help="random seed for the synthetic data"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds added to every response"
+    )
+    parser.add_argument(
+        "--rate-limit-rate",
+        type=float,
+        default=0.0,
+        help="share of requests answered with 429",
+    )
+    parser.add_argument(
+        "--retry-after",
+        type=int,
+        default=0,
+        help="Retry-After seconds sent with 429 responses",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=2,
+        help="number of consecutive syncs; later runs start from the state of earlier ones",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["rest", "graphql"],
+        default="rest",
+        help="Canvas fetch backend (default rest)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="load Todoist tasks with todoist_incremental_sync enabled",
+    )
+    parser.add_argument(
+        "--scope",
+        choices=["all", "projects", "label"],
+        default="all",
+        help="todoist_task_scope to load tasks with (default all)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="sync with stream_assignments enabled",
+    )
+    parser.add_argument(
+        "--async",
+        dest="async_engine",
+        action="store_true",
+        help="sync with easy_run's asyncio engine",
+    )
+    parser.add_argument(
+        "--events",
+        type=int,
+        default=0,
+        help="change this many assignments before every run after the first and sync them from replayed Live Events instead of a full sync",
+    )
+    parser.add_argument(
+        "--no-canvas-cache",
+        action="store_true",
+        help="sync with the Canvas HTTP cache disabled",
+    )
+    parser.add_argument(
+        "--unthrottled",
+        action="store_true",
+        help="disable easy_run's client side rate limits",
+    )
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("BEFORE", "AFTER"),
+        help="compare two saved reports",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.compare:
+        compare_reports(*args.compare)
+        return
+    report = run_benchmark(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,45 +3,1025 @@
 import requests
 import re
 import json
+import sqlite3
+import hashlib
+import calendar
+import argparse
+import uuid
+import asyncio
+import contextvars
+import signal
+import os
+import glob
+import cProfile
+import pstats
+import tracemalloc
+import hmac
 from todoist_api_python.api import TodoistAPI
+from todoist_api_python.api_async import TodoistAPIAsync
 from requests.auth import HTTPDigestAuth
-from datetime import datetime, timezone, timedelta
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from datetime import datetime, timezone, timedelta, date
 import time
-from random import randint
+import threading
+import queue
+import httpx
+from random import uniform
+from email.utils import parsedate_to_datetime
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from collections import Counter
+from urllib.parse import urlparse, urlunparse, parse_qs, urlencode
 
-# Load configuration files and creates a list of course_ids
-config = {}
-header = {}
+# Canvas request parameters and defaults shared by all profiles. Everything loaded
+# during a sync is kept on a SyncContext, one per config profile
 param = {"per_page": "100", "include": "submission", "enrollment_state": "active"}
-course_ids = []
-assignments = []
-todoist_tasks = []
-courses_id_name_dict = {}
-todoist_project_dict = {}
-throttle_number = 50  # Number of requests to make before sleeping for delay seconds
-sleep_delay_max = 2500  # Maximum number of milliseconds to sleep for
-max_added = 250  # Maximum number of assignments to add to Todoist at once. Todoist API limit is 450 requests per 15 minutes and you can quickly hit this if adding a massive number of assignments.
-limit_reached = False  # Global var used to terminate early if limit is reached or API returns an error.
+# Todoist allows 450 requests per 15 minutes per user
+todoist_rate_limit = (450, 15 * 60)
+# Canvas throttles on a 700 unit quota and charges ~50 units up front per request
+canvas_rate_limit = (14, 2)
+canvas_low_water = 150  # Slow down Canvas when X-Rate-Limit-Remaining drops below this
+canvas_request_cost = 50  # Approximate Canvas quota units used by one request
+max_retries = 5  # Times a rate limited or failed request is retried before giving up
+backoff_base = 1  # Seconds before the first retry, doubled on every further attempt
+backoff_max = 60  # Maximum number of seconds to wait between retries
+canvas_stream_queue_pages = (
+    8  # Canvas pages buffered between download and sync when streaming
+)
+canvas_graphql_page_size = 100  # Assignments per course in each GraphQL request
+canvas_graphql_courses = 20  # Courses fetched by a single GraphQL request
+canvas_fetch_workers = 4  # Default number of courses to fetch from Canvas in parallel. Set canvas_fetch_workers in config.json to override (1 fetches courses one at a time).
+canvas_page_workers = 4  # Default number of pages of a course to fetch in parallel once Canvas reports its last page. Set canvas_page_workers in config.json to override (1 follows the next links one page at a time).
+todoist_sync_url = "https://api.todoist.com/api/v1/sync"  # Todoist Sync API endpoint used for batched writes
+todoist_batch_size = 100  # Commands per Sync API request (Todoist allows up to 100)
+todoist_write_concurrency = 4  # Todoist write requests in flight at once with --async
+todoist_request_ids = contextvars.ContextVar(
+    "todoist_request_ids", default=None
+)  # uuid of the operation an async task is sending, see async_todoist_request_id()
+canvas_cache_file = "canvas_cache.db"  # HTTP cache of Canvas GET responses, kept next to config.json. Set canvas_cache_path in config.json to override.
+canvas_cache_max_bytes = (
+    64 * 1024 * 1024
+)  # Size of the cached Canvas responses before the least recently used are evicted
+canvas_course_list_ttl = (
+    24 * 60 * 60
+)  # Seconds the cached course list is used without asking Canvas
+sync_state_file = "sync_state.db"  # Local store of synced assignments, kept next to config.json. Set sync_state_path in config.json to override.
+daemon_poll_interval = 30 * 60  # Seconds between syncs in daemon mode
+daemon_near_due_interval = (
+    5 * 60
+)  # Seconds between syncs when an assignment is due soon
+daemon_near_due_hours = 24  # Hours before a due date in which to poll more often
+daemon_reload_cycles = 12  # Reload all Todoist tasks at least every N daemon cycles
+profile_workers = 4  # Default number of profiles synced in parallel by --profiles
+live_events_reconcile_interval = (
+    6 * 60 * 60
+)  # Seconds between full syncs with --listen, to catch missed events
+live_event_names = (
+    "assignment_created",
+    "assignment_updated",
+    "submission_created",
+)  # Canvas Live Events that trigger a sync of their assignment
+live_events_max_bytes = 1024 * 1024  # Largest request body accepted by --listen
+live_events_record_file = "live_events.jsonl"  # Events received by --listen are appended here when live_events_record is set in config.json. Set live_events_record_path to override.
+stop_requested = threading.Event()  # Set by SIGTERM/SIGINT to stop the daemon
+rate_limiters = {}  # (service, token): RateLimiter, so each token has its own budget
+rate_limiters_lock = threading.Lock()
+# Metrics report of the last sync, kept next to config.json. Set metrics_report_path in config.json to override
+metrics_report_file = "sync_metrics.json"
+# Upper bounds in seconds of the request latency histogram buckets
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+profile_stats_file = "easy_run.prof"  # cProfile output written by --profile
+memory_snapshot_file = (
+    "easy_run.tracemalloc"  # tracemalloc snapshot written by --profile
+)
+
+
+# Raised when a profile cannot be synced, e.g. because of an invalid API key
+class SyncError(Exception):
+    pass
+
+
+# Everything needed to sync one profile: its configuration, API clients, rate
+# limiters and the data loaded from Canvas and Todoist during a sync
+class SyncContext:
+    def __init__(self, config_path="config.json", quiet=False):
+        self.config_path = config_path
+        self.name = os.path.splitext(os.path.basename(config_path))[0]
+        self.quiet = quiet  # Keep messages in log_lines instead of printing them
+        self.log_lines = []
+        self.config = {}
+        self.course_ids = []
+        self.assignments = []
+        self.todoist_tasks = []
+        self.todoist_task_index = {"by_content": {}, "by_url": {}, "by_id": {}}
+        self.courses_id_name_dict = {}
+        self.todoist_project_dict = {}
+        self.limit_reached = (
+            False  # Set to terminate early if retries are exhausted on the Todoist API
+        )
+        self.todoist_api = None
+        self.canvas_session = (
+            requests.Session()
+        )  # Keep-alive session for Canvas requests
+        self.todoist_session = (
+            requests.Session()
+        )  # Session for Todoist Sync API requests
+        self.canvas_limiter = None
+        self.todoist_limiter = None
+        self.sync_state = (
+            None  # Connection to the sync state store, see open_sync_state()
+        )
+        self.canvas_cache = None  # CanvasCache, see open_canvas_cache()
+        self.sync_lock = threading.Lock()  # Held during a sync so cycles never overlap
+        self.counts = None  # Counters of the last transfer_assignments_to_todoist()
+        self.assignment_stats = None  # AssignmentStats of the last sync
+        self.graphql_unavailable = False  # Set when the GraphQL backend failed
+        self.dry_run = False  # Plan the sync and print it without writing to Todoist
+        self.async_engine = False  # Sync with AsyncSyncEngine instead of threads
+        self.todoist_request_id = None  # X-Request-Id of the next Todoist REST write
+        self.metrics = SyncMetrics()
+        self.canvas_session.hooks["response"].append(
+            partial(self.metrics.record_response, "Canvas")
+        )
+        self.todoist_session.hooks["response"].append(
+            partial(self.metrics.record_response, "Todoist")
+        )
+
+    def log(self, message=""):
+        if self.quiet:
+            self.log_lines.append(message)
+        else:
+            print(message)
+
+
+# Timings and request statistics of a profile. Phase durations are those of the last
+# sync, request, sleep and retry totals add up over all syncs of the process
+class SyncMetrics:
+    def __init__(self):
+        self.phases = {}
+        self.requests = Counter()  # (service, endpoint, status): count
+        self.latency = {}  # (service, endpoint): [bucket counts..., count, sum]
+        self.sleep_seconds = (
+            Counter()
+        )  # service: seconds spent waiting on the rate limiter
+        self.retries = Counter()  # service: retried requests
+        self.canvas_cache = Counter()  # "hits" and "misses" of the Canvas cache
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - started
+
+    def record_request(self, service, method, url, status, seconds):
+        endpoint = endpoint_name(method, url)
+        with self.lock:
+            self.requests[(service, endpoint, status)] += 1
+            histogram = self.latency.setdefault(
+                (service, endpoint), [0] * (len(latency_buckets) + 2)
+            )
+            for i, bound in enumerate(latency_buckets):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    # Response hook of the requests sessions
+    def record_response(self, service, response, *args, **kwargs):
+        self.record_request(
+            service,
+            response.request.method,
+            response.request.url,
+            response.status_code,
+            response.elapsed.total_seconds(),
+        )
+
+    def record_sleep(self, service, seconds):
+        with self.lock:
+            self.sleep_seconds[service] += seconds
+
+    def record_retry(self, service):
+        with self.lock:
+            self.retries[service] += 1
+
+    def record_cache(self, hit):
+        with self.lock:
+            self.canvas_cache["hits" if hit else "misses"] += 1
+
+
+# httpx transport that records the requests of the TodoistAPI client in SyncMetrics
+class MetricsTransport(httpx.BaseTransport):
+    def __init__(self, metrics, service, transport=None):
+        self.metrics = metrics
+        self.service = service
+        self.transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request):
+        started = time.perf_counter()
+        response = self.transport.handle_request(request)
+        self.metrics.record_request(
+            self.service,
+            request.method,
+            str(request.url),
+            response.status_code,
+            time.perf_counter() - started,
+        )
+        return response
+
+    def close(self):
+        self.transport.close()
+
+
+# Groups request URLs by endpoint, e.g. GET /api/v1/courses/{id}/assignments
+def endpoint_name(method, url):
+    segments = [
+        (
+            "{id}"
+            if re.search(r"\d", segment) and not re.fullmatch(r"v\d+", segment)
+            else segment
+        )
+        for segment in urlparse(url).path.split("/")
+    ]
+    return f"{method} {'/'.join(segments)}"
+
+
+# Writes the metrics report of the last sync as JSON, and as a Prometheus textfile
+# collector file when metrics_textfile_path is set in config.json
+def write_metrics(ctx):
+    report = metrics_report(ctx)
+    write_file_atomic(
+        ctx.config.get(
+            "metrics_report_path", profile_file_path(ctx, metrics_report_file)
+        ),
+        json.dumps(report, indent=2),
+    )
+    if ctx.config.get("metrics_textfile_path"):
+        write_file_atomic(ctx.config["metrics_textfile_path"], prometheus_text(report))
+    ctx.metrics.phases = {}
+
+
+def metrics_report(ctx):
+    metrics = ctx.metrics
+    endpoints = {}
+    with metrics.lock:
+        for (service, endpoint, status), count in sorted(metrics.requests.items()):
+            entry = endpoints.setdefault(
+                (service, endpoint), {"requests": 0, "statuses": {}}
+            )
+            entry["requests"] += count
+            entry["statuses"][str(status)] = count
+        for (service, endpoint), histogram in metrics.latency.items():
+            buckets = {
+                str(bound): histogram[i] for i, bound in enumerate(latency_buckets)
+            }
+            buckets["+Inf"] = histogram[-2]
+            endpoints[(service, endpoint)]["latency_seconds"] = {
+                "sum": round(histogram[-1], 4),
+                "buckets": buckets,
+            }
+        sleep_seconds = {
+            service: round(seconds, 3)
+            for service, seconds in metrics.sleep_seconds.items()
+        }
+        retries = dict(metrics.retries)
+        canvas_cache = {
+            "hits": metrics.canvas_cache["hits"],
+            "misses": metrics.canvas_cache["misses"],
+        }
+    return {
+        "profile": ctx.name,
+        "generated_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "phase_seconds": {
+            name: round(seconds, 4) for name, seconds in metrics.phases.items()
+        },
+        "counts": ctx.counts,
+        "requests": [
+            dict(service=service, endpoint=endpoint, **entry)
+            for (service, endpoint), entry in endpoints.items()
+        ],
+        "sleep_seconds": sleep_seconds,
+        "retries": retries,
+        "canvas_cache": canvas_cache,
+    }
+
+
+# Formats a metrics report in the Prometheus text exposition format
+def prometheus_text(report):
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP canvas_todoist_{name} {help_text}")
+        lines.append(f"# TYPE canvas_todoist_{name} {kind}")
+        for suffix, labels, value in samples:
+            labels = dict(profile=report["profile"], **labels)
+            label_text = ",".join(
+                f'{key}="{prometheus_escape(value)}"' for key, value in labels.items()
+            )
+            lines.append(f"canvas_todoist_{name}{suffix}{{{label_text}}} {value}")
+
+    metric(
+        "phase_duration_seconds",
+        "gauge",
+        "Duration of each phase of the last sync",
+        [
+            ("", {"phase": name}, seconds)
+            for name, seconds in report["phase_seconds"].items()
+        ],
+    )
+    metric(
+        "http_requests_total",
+        "counter",
+        "HTTP requests by endpoint and status",
+        [
+            (
+                "",
+                {
+                    "service": entry["service"],
+                    "endpoint": entry["endpoint"],
+                    "status": status,
+                },
+                count,
+            )
+            for entry in report["requests"]
+            for status, count in entry["statuses"].items()
+        ],
+    )
+    histogram_samples = []
+    for entry in report["requests"]:
+        labels = {"service": entry["service"], "endpoint": entry["endpoint"]}
+        latency = entry["latency_seconds"]
+        for bound, count in latency["buckets"].items():
+            histogram_samples.append(("_bucket", dict(labels, le=bound), count))
+        histogram_samples.append(("_sum", labels, latency["sum"]))
+        histogram_samples.append(("_count", labels, latency["buckets"]["+Inf"]))
+    metric(
+        "http_request_duration_seconds",
+        "histogram",
+        "HTTP request latency by endpoint",
+        histogram_samples,
+    )
+    metric(
+        "rate_limit_sleep_seconds_total",
+        "counter",
+        "Seconds spent waiting on the client side rate limiter",
+        [
+            ("", {"service": service}, seconds)
+            for service, seconds in report["sleep_seconds"].items()
+        ],
+    )
+    metric(
+        "retries_total",
+        "counter",
+        "Requests retried after a rate limit or transient error",
+        [
+            ("", {"service": service}, count)
+            for service, count in report["retries"].items()
+        ],
+    )
+    metric(
+        "canvas_cache_requests_total",
+        "counter",
+        "Canvas GET requests answered from the cache (hit) or downloaded (miss)",
+        [
+            ("", {"result": result}, count)
+            for result, count in report["canvas_cache"].items()
+        ],
+    )
+    metric(
+        "assignments",
+        "gauge",
+        "Assignments by result of the last sync",
+        [
+            ("", {"result": result}, count)
+            for result, count in (report["counts"] or {}).items()
+        ],
+    )
+    metric(
+        "last_sync_timestamp_seconds",
+        "gauge",
+        "Unix time the last sync finished",
+        [("", {}, int(datetime.fromisoformat(report["generated_at"]).timestamp()))],
+    )
+    return "\n".join(lines) + "\n"
+
+
+def prometheus_escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Replaces a file in one step, so readers such as the node_exporter never see a partial file
+def write_file_atomic(path, text):
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as output_file:
+        output_file.write(text)
+    os.replace(temporary_path, path)
 
 
 def main():
+    args = parse_args()
+    if args.profile:
+        run_profiled(run, args)
+    else:
+        run(args)
+
+
+def run(args):
+    if args.profiles:
+        run_profiles(args)
+        return
     print(f"  {'#'*52}")
     print(" #     Canvas-Assignments-Transfer-For-Todoist     #")
     print(f"{'#'*52}\n")
-    initialize_api()
-    print("API INITIALIZED")
-    select_courses()
-    print(f"Selected {len(course_ids)} courses")
-    print("Syncing Canvas Assignments...")
-    load_todoist_projects()
-    load_assignments()
-    load_todoist_tasks()
-    create_todoist_projects()
-    transfer_assignments_to_todoist()
-    canvas_assignment_stats()
+    ctx = SyncContext()
+    ctx.dry_run = args.dry_run
+    ctx.async_engine = args.async_engine
+    unattended = args.daemon or args.listen or args.replay
+    try:
+        initialize_api(ctx, interactive=not unattended)
+        print("API INITIALIZED")
+        open_sync_state(ctx, rebuild=args.rebuild_state)
+        open_canvas_cache(ctx)
+        if args.daemon:
+            run_daemon(ctx)
+            return
+        if args.listen:
+            run_listener(ctx, args.listen)
+            return
+        if args.replay:
+            run_replay(ctx, args.replay)
+            return
+        with ctx.metrics.phase("select_courses"):
+            select_courses(ctx)
+        print(f"Selected {len(ctx.course_ids)} courses")
+        run_sync_cycle(ctx)
+    except SyncError as error:
+        print(error)
+        exit()
     print("Done!")
 
 
+# Runs func under cProfile and tracemalloc, then dumps the profile and a memory
+# snapshot and prints the top entries of both
+def run_profiled(func, *args):
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        func(*args)
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        profiler.dump_stats(profile_stats_file)
+        snapshot.dump(memory_snapshot_file)
+        print(f"Profile written to {profile_stats_file}, top functions:")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(10)
+        print(f"Memory snapshot written to {memory_snapshot_file}, top allocations:")
+        for stat in snapshot.statistics("lineno")[:10]:
+            print(stat)
+
+
+# Runs one sync of the selected courses. reload_todoist=False reuses the Todoist
+# projects, tasks and task index loaded by a previous cycle. Returns the transfer counts
+def run_sync_cycle(ctx, reload_todoist=True):
+    with ctx.sync_lock:
+        ctx.limit_reached = False
+        ctx.log("Syncing Canvas Assignments...")
+        ctx.assignments.clear()
+        metrics = ctx.metrics
+        if ctx.async_engine:
+            asyncio.run(async_sync_cycle(ctx, reload_todoist))
+            return finish_sync_cycle(ctx)
+        # Streaming syncs assignments while they are downloaded instead of loading them first
+        stream = ctx.config.get("stream_assignments", False)
+        if reload_todoist:
+            ctx.todoist_project_dict.clear()
+            ctx.todoist_tasks.clear()
+            with metrics.phase("load_todoist_projects"):
+                load_todoist_projects(ctx)
+        if not stream:
+            with metrics.phase("load_assignments"):
+                load_assignments(ctx)
+        if reload_todoist:
+            with metrics.phase("load_todoist_tasks"):
+                load_todoist_tasks(ctx)
+            with metrics.phase("build_todoist_task_index"):
+                build_todoist_task_index(ctx)
+        with metrics.phase("create_todoist_projects"):
+            create_todoist_projects(ctx)
+        if stream:
+            stats = AssignmentStats()
+            with metrics.phase("stream_assignments_to_todoist"):
+                transfer_assignments_to_todoist(ctx, stream_assignments(ctx, stats))
+            canvas_assignment_stats(ctx, stats)
+        else:
+            with metrics.phase("transfer_assignments_to_todoist"):
+                transfer_assignments_to_todoist(ctx)
+            canvas_assignment_stats(ctx)
+        return finish_sync_cycle(ctx)
+
+
+# Logs the Canvas cache statistics and writes the metrics report after a sync cycle
+def finish_sync_cycle(ctx):
+    if ctx.canvas_cache is not None:
+        cache = ctx.metrics.canvas_cache
+        ctx.log(f"Canvas Cache Hits: {cache['hits']}, Misses: {cache['misses']}")
+    write_metrics(ctx)
+    return ctx.counts
+
+
+# Runs the sync on a schedule without any prompts until SIGTERM or SIGINT is received.
+# Sessions, course names and the Todoist task index stay in memory between cycles
+def run_daemon(ctx):
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    with ctx.metrics.phase("select_courses"):
+        select_courses(ctx, interactive=False)
+    ctx.log(f"Selected {len(ctx.course_ids)} courses")
+    reload_todoist = True
+    cycle = 0
+    while not stop_requested.is_set():
+        try:
+            counts = run_sync_cycle(ctx, reload_todoist=reload_todoist)
+        except Exception as error:
+            ctx.log(f"Error during sync cycle: {error}")
+            counts = None
+        cycle += 1
+        # Reload Todoist after writes, since written tasks are not in the index yet
+        reload_todoist = (
+            counts is None
+            or counts["added"] > 0
+            or counts["updated"] > 0
+            or cycle % ctx.config.get("daemon_reload_cycles", daemon_reload_cycles) == 0
+        )
+        interval = next_poll_interval(ctx)
+        ctx.log(f"Next sync in {interval} seconds")
+        stop_requested.wait(interval)
+    ctx.sync_state.close()
+    if ctx.canvas_cache is not None:
+        ctx.canvas_cache.close()
+    ctx.log("Daemon stopped")
+
+
+# Signal handler for the daemon. The running cycle is finished before stopping
+def request_stop(signum, frame):
+    print(f"Received signal {signum}, stopping after the current sync...")
+    stop_requested.set()
+
+
+# Polls more often while an unsubmitted assignment is due within daemon_near_due_hours
+def next_poll_interval(ctx):
+    now = time.time()
+    near_due = (
+        now
+        + timedelta(
+            hours=ctx.config.get("daemon_near_due_hours", daemon_near_due_hours)
+        ).total_seconds()
+    )
+    stats = ctx.assignment_stats
+    if stats is not None and stats.next_due is not None:
+        if now <= stats.next_due <= near_due:
+            return ctx.config.get("daemon_near_due_interval", daemon_near_due_interval)
+    return ctx.config.get("daemon_poll_interval", daemon_poll_interval)
+
+
+# Syncs on Canvas Live Events instead of polling. Every event about an assignment of a
+# selected course queues a sync of just that assignment, see sync_assignments(). A full
+# sync runs at start and every live_events_reconcile_interval seconds to catch events
+# that were missed. Runs until SIGTERM or SIGINT is received
+def run_listener(ctx, address):
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    with ctx.metrics.phase("select_courses"):
+        select_courses(ctx, interactive=False)
+    ctx.log(f"Selected {len(ctx.course_ids)} courses")
+    events = LiveEventQueue()
+    host, port = parse_listen_address(address)
+    server = start_live_event_server(ctx, events, host, port)
+    ctx.log(f"Listening for Canvas Live Events on {host}:{port}")
+    if not ctx.config.get("live_events_secret") and host not in ("127.0.0.1", "::1"):
+        ctx.log("Warning: live_events_secret is not set, anyone can post events")
+    interval = ctx.config.get(
+        "live_events_reconcile_interval", live_events_reconcile_interval
+    )
+    next_reconcile = time.monotonic()
+    try:
+        while not stop_requested.is_set():
+            if time.monotonic() >= next_reconcile:
+                started = time.monotonic()
+                try:
+                    run_sync_cycle(ctx)
+                    # Events queued before the full sync started are covered by it
+                    events.discard_before(started)
+                    wait = interval
+                except Exception as error:
+                    ctx.log(f"Error during sync cycle: {error}")
+                    wait = min(interval, daemon_poll_interval)
+                next_reconcile = started + wait
+                ctx.log(f"Next full sync in {round(wait)} seconds")
+                continue
+            keys = events.take(min(1, next_reconcile - time.monotonic()))
+            if not keys:
+                continue
+            try:
+                sync_assignments(ctx, keys)
+            except Exception as error:
+                ctx.log(f"Error while syncing changed assignments: {error}")
+            write_metrics(ctx)
+    finally:
+        server.shutdown()
+        server.server_close()
+        ctx.sync_state.close()
+        if ctx.canvas_cache is not None:
+            ctx.canvas_cache.close()
+    ctx.log("Listener stopped")
+
+
+# Feeds recorded Live Events payloads through the same queue as --listen and syncs the
+# queued assignments, without a full sync first. Lets event handling be tried offline
+def run_replay(ctx, path):
+    payloads = read_live_events(path)
+    with ctx.metrics.phase("select_courses"):
+        select_courses(ctx, interactive=False)
+    load_todoist_state(ctx)
+    replay_live_events(ctx, payloads)
+    write_metrics(ctx)
+
+
+def replay_live_events(ctx, payloads):
+    events = LiveEventQueue()
+    queued = sum(queue_live_event(ctx, events, payload) for payload in payloads)
+    ctx.log(f"Replaying {len(payloads)} events, {queued} about selected courses")
+    keys = events.take(0)
+    if keys:
+        sync_assignments(ctx, keys)
+
+
+# Parses the [HOST:]PORT of --listen. The host defaults to 127.0.0.1
+def parse_listen_address(address):
+    host, _, port = address.rpartition(":")
+    if not port.isdigit():
+        raise SyncError(f"Invalid --listen address {address}, expected [HOST:]PORT")
+    return host.strip("[]") or "127.0.0.1", int(port)
+
+
+# Loads what a targeted sync needs from Todoist when no full sync ran before it
+def load_todoist_state(ctx):
+    metrics = ctx.metrics
+    with metrics.phase("load_todoist_projects"):
+        load_todoist_projects(ctx)
+    with metrics.phase("load_todoist_tasks"):
+        load_todoist_tasks(ctx)
+    with metrics.phase("build_todoist_task_index"):
+        build_todoist_task_index(ctx)
+    with metrics.phase("create_todoist_projects"):
+        create_todoist_projects(ctx)
+
+
+# Syncs the assignments of (course_id, assignment_id) keys with the Todoist projects and
+# task index of the last full sync. The assignments are fetched from Canvas again, so
+# events only say what changed. Returns the transfer counts
+def sync_assignments(ctx, keys):
+    with ctx.sync_lock:
+        ctx.limit_reached = False
+        workers = max(
+            1, int(ctx.config.get("canvas_fetch_workers", canvas_fetch_workers))
+        )
+        with ctx.metrics.phase("load_changed_assignments"):
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                assignments = [
+                    assignment
+                    for assignment in executor.map(partial(fetch_assignment, ctx), keys)
+                    if assignment is not None
+                ]
+        ctx.log(f"Syncing {len(assignments)} assignments changed in Canvas")
+        with ctx.metrics.phase("sync_changed_assignments"):
+            return transfer_assignments_to_todoist(ctx, assignments)
+
+
+# Loads a single assignment with its submission, None if it was deleted from Canvas
+def fetch_assignment(ctx, key):
+    course_id, assignment_id = key
+    response = canvas_get(
+        ctx,
+        f"{ctx.config['canvas_api_heading']}/api/v1/courses/{course_id}/assignments/{assignment_id}",
+        params={"include": param["include"]},
+    )
+    if response.status_code == 404:
+        ctx.log(f"Assignment {assignment_id} of course {course_id} not found")
+        return None
+    response.raise_for_status()
+    return Assignment(response.json())
+
+
+# Assignments waiting for a targeted sync after a Live Event, in arrival order, with the
+# time of their latest event. An assignment that changes again before it is synced is
+# synced only once
+class LiveEventQueue:
+    def __init__(self):
+        self.pending = {}
+        self.condition = threading.Condition()
+
+    def put(self, key):
+        with self.condition:
+            self.pending[key] = time.monotonic()
+            self.condition.notify()
+
+    # Waits up to timeout seconds for an event and returns all queued keys
+    def take(self, timeout):
+        with self.condition:
+            if not self.pending and timeout > 0:
+                self.condition.wait(timeout)
+            keys = list(self.pending)
+            self.pending.clear()
+            return keys
+
+    def discard_before(self, started):
+        with self.condition:
+            for key, queued in list(self.pending.items()):
+                if queued < started:
+                    del self.pending[key]
+
+
+# Queues the assignment of a Live Events payload. Returns False if the event is ignored
+def queue_live_event(ctx, events, payload):
+    key = live_event_assignment(payload)
+    if key is None or key[0] not in ctx.course_ids:
+        return False
+    events.put(key)
+    return True
+
+
+# The (course_id, assignment_id) of a Canvas Live Event in live_event_names, None for
+# other events. Events carry their name and context in metadata and the changed object
+# in body. Submission events only have the course in metadata
+def live_event_assignment(payload):
+    if not isinstance(payload, dict):
+        return None
+    metadata = payload.get("metadata") or {}
+    body = payload.get("body") or {}
+    if metadata.get("event_name") not in live_event_names:
+        return None
+    context = body if "context_type" in body else metadata
+    if context.get("context_type") != "Course":
+        return None
+    try:
+        return (
+            local_canvas_id(context["context_id"]),
+            local_canvas_id(body["assignment_id"]),
+        )
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+# Live Events use global ids, which add the shard id times 10**13 to the id the REST
+# API uses
+def local_canvas_id(value):
+    return int(value) % 10**13
+
+
+# Reads recorded Live Events payloads from a file with a JSON list or one payload per
+# line, as written by live_events_record
+def read_live_events(path):
+    try:
+        with open(path) as events_file:
+            text = events_file.read()
+    except OSError as error:
+        raise SyncError(f"Could not read {path}: {error}")
+    try:
+        payloads = json.loads(text)
+    except ValueError:
+        try:
+            payloads = [json.loads(line) for line in text.splitlines() if line.strip()]
+        except ValueError as error:
+            raise SyncError(f"{path} is not a Live Events recording: {error}")
+    return payloads if isinstance(payloads, list) else [payloads]
+
+
+# Starts the --listen server in a background thread
+def start_live_event_server(ctx, events, host, port):
+    handler = type(
+        "LiveEventHandler", (LiveEventHandler,), {"ctx": ctx, "events": events}
+    )
+    try:
+        server = ThreadingHTTPServer((host, port), handler)
+    except OSError as error:
+        raise SyncError(f"Could not listen on {host}:{port}: {error}")
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Receives Canvas Live Events posted as JSON, one event or a list of events per request.
+# Events are queued and answered with 202 right away, the syncs run in run_listener().
+# When live_events_secret is set in config.json requests must send it as a bearer token
+class LiveEventHandler(BaseHTTPRequestHandler):
+    ctx = None
+    events = None
+    record_lock = threading.Lock()
+
+    def do_POST(self):
+        config = self.ctx.config
+        secret = config.get("live_events_secret")
+        if secret and not hmac.compare_digest(
+            self.headers.get("Authorization", "").encode(), f"Bearer {secret}".encode()
+        ):
+            return self.respond(401)
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            return self.respond(400)
+        if length < 0:
+            return self.respond(400)
+        if length > live_events_max_bytes:
+            return self.respond(413)
+        try:
+            payload = json.loads(self.rfile.read(length))
+        except ValueError:
+            return self.respond(400)
+        payloads = payload if isinstance(payload, list) else [payload]
+        if config.get("live_events_record", False):
+            self.record(payloads)
+        for payload in payloads:
+            queue_live_event(self.ctx, self.events, payload)
+        self.respond(202)
+
+    # Appends the payloads to the recording that --replay reads
+    def record(self, payloads):
+        path = self.ctx.config.get(
+            "live_events_record_path",
+            profile_file_path(self.ctx, live_events_record_file),
+        )
+        with self.record_lock, open(path, "a") as record_file:
+            for payload in payloads:
+                record_file.write(json.dumps(payload) + "\n")
+
+    def respond(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Syncs every *.json config profile in the --profiles directory without prompts, with
+# at most --workers profiles at a time, and prints a summary table at the end. The
+# metrics reports written next to the profiles are not profiles
+def run_profiles(args):
+    directory, workers = args.profiles, args.workers
+    paths = [
+        path
+        for path in sorted(glob.glob(os.path.join(directory, "*.json")))
+        if os.path.basename(path) != metrics_report_file
+        and not path.endswith(f".{metrics_report_file}")
+    ]
+    if not paths:
+        print(f"No config profiles found in {directory}")
+        exit()
+    print(f"Syncing {len(paths)} profiles with {workers} workers...")
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(executor.map(partial(sync_profile, args), paths))
+    print_profile_summary(results)
+    if args.dry_run:
+        print("Dry run, nothing was sent to Todoist")
+
+
+# Syncs a single profile with the command line options of the run and returns its row
+# for the summary table
+def sync_profile(args, path):
+    ctx = SyncContext(path, quiet=True)
+    ctx.dry_run = args.dry_run
+    ctx.async_engine = args.async_engine
+    started = time.monotonic()
+    status = "ok"
+    try:
+        initialize_api(ctx, interactive=False)
+        open_sync_state(ctx, rebuild=args.rebuild_state)
+        open_canvas_cache(ctx)
+        with ctx.metrics.phase("select_courses"):
+            select_courses(ctx, interactive=False)
+        run_sync_cycle(ctx)
+        if ctx.limit_reached:
+            status = "limit reached"
+    except Exception as error:
+        status = f"error: {error}"
+    finally:
+        if ctx.sync_state is not None:
+            ctx.sync_state.close()
+        if ctx.canvas_cache is not None:
+            ctx.canvas_cache.close()
+    counts = ctx.counts or {}
+    return {
+        "profile": ctx.name,
+        "courses": len(ctx.course_ids),
+        "assignments": (
+            ctx.assignment_stats.total
+            if ctx.assignment_stats is not None
+            else len(ctx.assignments)
+        ),
+        "added": counts.get("added", 0),
+        "updated": counts.get("updated", 0),
+        "synced": counts.get("synced", 0),
+        "excluded": counts.get("excluded", 0),
+        "failed": counts.get("failed", 0),
+        "seconds": round(time.monotonic() - started, 1),
+        "status": status,
+    }
+
+
+def print_profile_summary(results):
+    columns = [
+        "profile",
+        "courses",
+        "assignments",
+        "added",
+        "updated",
+        "synced",
+        "excluded",
+        "failed",
+        "seconds",
+        "status",
+    ]
+    widths = {
+        column: max(len(column), *(len(str(row[column])) for row in results))
+        for column in columns
+    }
+    print(f"  {'-'*52}")
+    print(
+        "  ".join(column.title().ljust(widths[column]) for column in columns).rstrip()
+    )
+    for row in results:
+        print(
+            "  ".join(
+                str(row[column]).ljust(widths[column]) for column in columns
+            ).rstrip()
+        )
+    failed = sum(1 for row in results if row["status"] != "ok")
+    print(f"Synced {len(results) - failed} of {len(results)} profiles")
+
+
+# Parses command line options
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Transfer Canvas assignments to Todoist"
+    )
+    parser.add_argument(
+        "--rebuild-state",
+        action="store_true",
+        help="discard the local sync state and rebuild it from scratch on this run",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and re-sync on a schedule without prompts (requires an existing config.json with selected courses)",
+    )
+    parser.add_argument(
+        "--listen",
+        metavar="[HOST:]PORT",
+        help="receive Canvas Live Events on this address and sync the changed assignments, with a periodic full sync (requires an existing config.json with selected courses)",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="FILE",
+        help="sync the assignments of the Canvas Live Events recorded in FILE, as --listen would, and exit",
+    )
+    parser.add_argument(
+        "--profiles",
+        metavar="DIR",
+        help="sync every *.json config profile in DIR without prompts and print a summary table",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=profile_workers,
+        help=f"number of profiles to sync in parallel with --profiles (default {profile_workers})",
+    )
+    parser.add_argument(
+        "--async",
+        dest="async_engine",
+        action="store_true",
+        help="sync with the asyncio engine, which loads Todoist while Canvas downloads and sends writes concurrently",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="print the planned Todoist adds and updates without sending them",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=f"profile the run and write {profile_stats_file} (cProfile) and {memory_snapshot_file} (tracemalloc snapshot); only the main thread is profiled",
+    )
+    return parser.parse_args()
+
+
 # Function for Yes/No response prompts during setup
 def yes_no(question: str) -> bool:
     reply = None
@@ -51,23 +1031,48 @@ def yes_no(question: str) -> bool:
 
 
 # Makes sure that the user has their api keys and canvas url in the config.json
-def initialize_api():
-    global config
-    global todoist_api
-
+def initialize_api(ctx, interactive=True):
     try:
-        with open("config.json") as config_file:
-            config = json.load(config_file)
+        with open(ctx.config_path) as config_file:
+            ctx.config = json.load(config_file)
     except FileNotFoundError:
+        if not interactive:
+            raise SyncError(
+                f"{ctx.config_path} not found, run easy_run.py once to configure it"
+            )
         print("File not Found, running Initial Configuration")
-        initial_config()
+        initial_config(ctx)
 
-    # create todoist_api object globally
-    todoist_api = TodoistAPI(config["todoist_api_key"].strip())
-    header.update({"Authorization": f"Bearer {config['canvas_api_key'].strip()}"})
+    config = ctx.config
+    ctx.todoist_api = TodoistAPI(
+        config["todoist_api_key"].strip(),
+        request_id_fn=partial(todoist_request_id, ctx),
+        client=httpx.Client(transport=MetricsTransport(ctx.metrics, "Todoist")),
+    )
+    # Size the Canvas connection pool to the number of parallel course and page fetches
+    workers = max(1, int(config.get("canvas_fetch_workers", canvas_fetch_workers)))
+    adapter = HTTPAdapter(
+        pool_connections=workers, pool_maxsize=workers * page_workers(ctx)
+    )
+    ctx.canvas_session.mount("https://", adapter)
+    ctx.canvas_session.mount("http://", adapter)
+    ctx.canvas_session.headers.update(
+        {"Authorization": f"Bearer {config['canvas_api_key'].strip()}"}
+    )
+    ctx.todoist_session.headers.update(
+        {"Authorization": f"Bearer {config['todoist_api_key'].strip()}"}
+    )
+    # Rate limits apply per token, so profiles sharing a token share the budget
+    ctx.canvas_limiter = get_rate_limiter(
+        "Canvas", config["canvas_api_key"].strip(), canvas_rate_limit
+    )
+    ctx.todoist_limiter = get_rate_limiter(
+        "Todoist", config["todoist_api_key"].strip(), todoist_rate_limit
+    )
 
 
-def initial_config():  # Initial configuration for first time users
+def initial_config(ctx):  # Initial configuration for first time users
+    config = ctx.config
     print(
         "Your Todoist API key has not been configured. To add an API token, go to your Todoist settings and copy the API token listed under the Integrations Tab. Copy the token and paste below when you are done."
     )
@@ -120,32 +1125,153 @@ def initial_config():  # Initial configuration for first time users
             config["sync_locked_assignments"] = True
             config["sync_no_due_date_assignments"] = True
     config["courses"] = []
-    with open("config.json", "w") as outfile:
+    with open(ctx.config_path, "w") as outfile:
         json.dump(config, outfile)
 
 
+# Opens the local sync state store that maps Canvas assignment ids to Todoist task ids,
+# together with a fingerprint of what was last synced for the assignment
+def open_sync_state(ctx, rebuild=False):
+    ctx.sync_state = sqlite3.connect(sync_state_path(ctx))
+    ctx.sync_state.execute("""CREATE TABLE IF NOT EXISTS synced_assignments (
+            assignment_id INTEGER PRIMARY KEY,
+            task_id TEXT,
+            fingerprint TEXT NOT NULL,
+            synced_at TEXT NOT NULL
+        )""")
+    # Local copy of the Todoist tasks and projects for todoist_incremental_sync
+    columns = [
+        row[1] for row in ctx.sync_state.execute("PRAGMA table_info(todoist_items)")
+    ]
+    if columns and "due_date" not in columns:
+        # Copies made before due_all_day, deadline and due_date were stored are
+        # downloaded again
+        ctx.sync_state.execute("DROP TABLE todoist_items")
+        ctx.sync_state.execute("DROP TABLE IF EXISTS todoist_sync")
+    ctx.sync_state.execute("""CREATE TABLE IF NOT EXISTS todoist_items (
+            id TEXT PRIMARY KEY,
+            content TEXT NOT NULL,
+            project_id TEXT NOT NULL,
+            due INTEGER,
+            due_all_day INTEGER NOT NULL,
+            deadline TEXT,
+            labels TEXT NOT NULL,
+            due_date TEXT
+        )""")
+    ctx.sync_state.execute("""CREATE TABLE IF NOT EXISTS todoist_projects (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL
+        )""")
+    ctx.sync_state.execute("""CREATE TABLE IF NOT EXISTS todoist_sync (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )""")
+    # Planned Todoist writes that have not been applied yet, see journal_operations()
+    ctx.sync_state.execute("""CREATE TABLE IF NOT EXISTS sync_journal (
+            position INTEGER PRIMARY KEY,
+            operation TEXT NOT NULL
+        )""")
+    if rebuild:
+        ctx.sync_state.execute("DELETE FROM synced_assignments")
+        ctx.sync_state.execute("DELETE FROM todoist_sync")
+        ctx.sync_state.execute("DELETE FROM sync_journal")
+        ctx.log("Sync state cleared, rebuilding from scratch")
+    ctx.sync_state.commit()
+
+
+# Opens the Canvas HTTP cache unless canvas_cache is set to false in config.json
+def open_canvas_cache(ctx):
+    if ctx.config.get("canvas_cache", True):
+        ctx.canvas_cache = CanvasCache(
+            ctx.config.get(
+                "canvas_cache_path", profile_file_path(ctx, canvas_cache_file)
+            ),
+            ctx.config.get("canvas_cache_max_bytes", canvas_cache_max_bytes),
+        )
+
+
+def sync_state_path(ctx):
+    return ctx.config.get("sync_state_path", profile_file_path(ctx, sync_state_file))
+
+
+# Files of a profile are kept next to its config file: e.g. sync_state.db for
+# config.json, and <profile>.sync_state.db for other profiles
+def profile_file_path(ctx, filename):
+    directory, config_filename = os.path.split(ctx.config_path)
+    if config_filename == "config.json":
+        return os.path.join(directory, filename)
+    return os.path.join(directory, f"{ctx.name}.{filename}")
+
+
+# Loads the sync state as a dictionary of assignment_id: (task_id, fingerprint)
+def load_sync_state(ctx):
+    rows = ctx.sync_state.execute(
+        "SELECT assignment_id, task_id, fingerprint FROM synced_assignments"
+    )
+    return {row[0]: (row[1], row[2]) for row in rows}
+
+
+# Records the outcome of syncing an assignment. task_id is None for assignments
+# that were deliberately not added (e.g. already submitted)
+def record_sync_state(ctx, assignment_id, task_id, fingerprint):
+    ctx.sync_state.execute(
+        "INSERT OR REPLACE INTO synced_assignments VALUES (?, ?, ?, ?)",
+        (
+            assignment_id,
+            task_id,
+            fingerprint,
+            datetime.now(timezone.utc).isoformat(),
+        ),
+    )
+
+
+# Fingerprint of the assignment fields that decide what is synced to Todoist
+def assignment_fingerprint(assignment, project_id):
+    parts = [
+        assignment.name,
+        assignment.due_at or "",
+        assignment.workflow_state,
+        str(project_id),
+    ]
+    return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
 # Allows the user to select the courses that they want to transfer while generating a dictionary
-# that has course ids as the keys and their names as the values
+# that has course ids as the keys and their names as the values. When not interactive
+# the courses selected last time are used without prompting
 
 
-def select_courses():
-    global config
+def select_courses(ctx, interactive=True):
+    config = ctx.config
+    course_ids = ctx.course_ids
+    courses_id_name_dict = ctx.courses_id_name_dict
+
+    if not interactive and not config["courses"]:
+        raise SyncError("No courses selected, run easy_run.py once to select courses")
 
     try:
-        response = requests.get(
+        # Once courses are selected the course list is only needed for their names
+        response = canvas_get(
+            ctx,
             f"{config['canvas_api_heading']}/api/v1/courses",
-            headers=header,
             params=param,
+            ttl=(
+                config.get("canvas_course_list_ttl", canvas_course_list_ttl)
+                if config["courses"]
+                else None
+            ),
         )
         if response.status_code == 401:
-            print("Unauthorized; Check API Key")
-            exit()
+            raise SyncError("Unauthorized; Check API Key")
         # Note that only courses in "Active" state are returned
         if config["courses"]:
-            use_previous_input = input(
-                "You have previously selected courses. Would you like to use the courses selected last time? (y/n) "
-            )
-            print("")
+            if interactive:
+                use_previous_input = input(
+                    "You have previously selected courses. Would you like to use the courses selected last time? (y/n) "
+                )
+                print("")
+            else:
+                use_previous_input = "y"
             if use_previous_input == "y" or use_previous_input == "Y":
                 course_ids.extend(
                     list(map(lambda course_id: int(course_id), config["courses"]))
@@ -155,10 +1281,12 @@ def select_courses():
                         r"[^-a-zA-Z0-9._\s]", "", course.get("name", "")
                     )
                 return
+    except SyncError:
+        raise
     except Exception as error:
-        print(f"Error while loading courses: {error}")
-        print(f"Check API Key and Canvas URL")
-        exit()
+        raise SyncError(
+            f"Error while loading courses: {error}\nCheck API Key and Canvas URL"
+        )
 
     # If the user does not choose to use courses selected last time
     for i, course in enumerate(response.json(), start=1):
@@ -185,315 +1313,2203 @@ def select_courses():
 
     # write course ids to config.json
     config["courses"] = course_ids
-    with open("config.json", "w") as outfile:
+    with open(ctx.config_path, "w") as outfile:
         json.dump(config, outfile)
 
 
-# Iterates over the course_ids list and loads all of the users assignments
-# for those classes. Appends assignment objects to assignments list
-def load_assignments():
-    try:
-        for course_id in course_ids:
-            response = requests.get(
-                f"{config['canvas_api_heading']}/api/v1/courses/{str(course_id)}/assignments",
-                headers=header,
-                params=param,
-            )
-            if response.status_code == 401:
-                print("Unauthorized; Check API Key")
-                exit()
-            paginated = response.json()
-            while "next" in response.links:
-                sleep()  # Throttle requests to Canvas API to prevent rate limiting on multiple pages
-                response = requests.get(
-                    response.links["next"]["url"], headers=header, params=param
-                )
-                paginated.extend(response.json())
-            print(
-                f"Loaded {len(paginated)} Assignments for Course {courses_id_name_dict[course_id]}"
-            )
-            assignments.extend(paginated)
-        print(f"Loaded {len(assignments)} Total Canvas Assignments")
-        return
-    except Exception as error:
-        print(f"Error while loading Assignments: {error}")
-        print(f"Check or regenerate API Key and Canvas URL")
-        exit()
+# Loads all assignments for a single course, following Canvas pagination links
+def fetch_course_assignments(ctx, course_id):
+    paginated = []
+    for page in iter_course_assignment_pages(ctx, course_id):
+        paginated.extend(page)
+    return paginated
 
 
-# Loads all user tasks from Todoist
-def load_todoist_tasks():
-    tasks = todoist_api.get_tasks()
-    todoist_tasks.extend(tasks)
-    print(f"Loaded {len(todoist_tasks)} Todoist Tasks")
+# Compact record of the Canvas assignment fields used by the sync and the statistics.
+# Dates are parsed once into UTC epoch seconds, due_at keeps the Canvas string for Todoist
+class Assignment:
+    __slots__ = (
+        "id",
+        "course_id",
+        "name",
+        "html_url",
+        "due_at",
+        "due",
+        "unlock_at",
+        "locked_for_user",
+        "lock_explanation",
+        "submission_type",
+        "graded_submissions_exist",
+        "workflow_state",
+        "graded_at",
+    )
 
+    def __init__(self, data):
+        self.id = data["id"]
+        self.course_id = data["course_id"]
+        self.name = data["name"]
+        self.html_url = data["html_url"]
+        self.due_at = data["due_at"]
+        self.due = parse_timestamp(data["due_at"])
+        self.unlock_at = parse_timestamp(data["unlock_at"])
+        self.locked_for_user = data["locked_for_user"]
+        self.lock_explanation = data.get("lock_explanation", "")
+        self.submission_type = (data.get("submission_types") or [None])[0]
+        self.graded_submissions_exist = data["graded_submissions_exist"]
+        self.workflow_state = data["submission"]["workflow_state"]
+        self.graded_at = parse_timestamp(data["submission"]["graded_at"])
 
-# Loads all user projects from Todoist
-def load_todoist_projects():
-    projects = todoist_api.get_projects()
-    for project in projects:
-        todoist_project_dict[project.name] = project.id
-    print(f"Loaded {len(todoist_project_dict)} Todoist Projects")
 
+# Compact record of the Todoist task fields used for matching. due is in UTC epoch
+# seconds (see todoist_due_timestamp()), due_all_day is set for dues without a time
+# and deadline is a YYYY-MM-DD date. due_date is the due date as Todoist returns it,
+# only used to count the updates that comparing it as a string would have sent
+class TodoistTask:
+    __slots__ = (
+        "id",
+        "content",
+        "project_id",
+        "due",
+        "due_all_day",
+        "deadline",
+        "due_date",
+    )
 
-# Checks to see if the user has a project matching their course names, if there
-# is not a new project will be created
-def create_todoist_projects():
-    for course_id in course_ids:
-        if courses_id_name_dict[course_id] not in todoist_project_dict:
-            project = todoist_api.add_project(courses_id_name_dict[course_id])
-            print(f"Project {courses_id_name_dict[course_id]} created")
-            todoist_project_dict[project.name] = project.id
-        else:
-            print(f"Project {courses_id_name_dict[course_id]} exists")
+    def __init__(
+        self,
+        id,
+        content,
+        project_id,
+        due,
+        due_all_day=False,
+        deadline=None,
+        due_date=None,
+    ):
+        self.id = id
+        self.content = content
+        self.project_id = project_id
+        self.due = due
+        self.due_all_day = due_all_day
+        self.deadline = deadline
+        self.due_date = due_date
 
 
-# Transfers over assignments from canvas over to Todoist, the method Checks
-# to make sure the assignment has not already been transferred to prevent overlap
-def transfer_assignments_to_todoist():
-    new_added = 0
-    updated = 0
-    already_synced = 0
-    excluded = 0
-    global limit_reached
-    global throttle_number
-    request_count = 0
-    for assignment in assignments:
-        course_name = courses_id_name_dict[assignment["course_id"]]
-        project_id = todoist_project_dict[course_name]
+# Converts a task returned by the TodoistAPI client into a TodoistTask
+def todoist_task(task):
+    due = task.due.date if task.due is not None else None
+    return TodoistTask(
+        task.id,
+        task.content,
+        task.project_id,
+        todoist_due_timestamp(due),
+        is_all_day(due),
+        todoist_date_string(task.deadline.date if task.deadline is not None else None),
+        todoist_due_string(due),
+    )
 
-        is_added = False
-        is_synced = True
 
-        for task in todoist_tasks:
-            # Check if assignment is already added to Todoist with same name and within the same Project
-            if (
-                task.content == f"[{assignment['name']}]({assignment['html_url']}) Due"
-                and task.project_id == project_id
-            ):
-                is_added = True
-                # Ignore updates if assignment has no due date and already synced
-                if assignment["due_at"] is None:
-                    break
-                # Handle case where task does not have due date but assignment does
-                if task.due is None and assignment["due_at"] is not None:
-                    is_synced = False
-                    print(
-                        f"Updating assignment due date: {course_name}:{assignment['name']} to {str(assignment['due_at'])}"
-                    )
-                    update_task(assignment, task)
-                    request_count += 1
-                    break
-                # Check for existence of task.due first to prevent error
-                if task.due is not None:
-                    # Handle case where assignment and task both have due dates but they are different
-                    if assignment["due_at"] != task.due.datetime:
-                        is_synced = False
-                        print(
-                            f"Updating assignment due date: {course_name}:{assignment['name']} to {str(assignment['due_at'])}"
-                        )
-                        update_task(assignment, task)
-                        request_count += 1
-                        break
-
-            # Handle case where assignment is not graded
-            if config["sync_null_assignments"] == False:
-                ## This is hacky, but it works for now - need to fix this
-                if (
-                    assignment["submission_types"][0] == "not_graded"
-                    or assignment["submission_types"][0] == "none"
-                    or assignment["submission_types"][0] == "on_paper"
-                ):
-                    print(
-                        f"Excluding ungraded/non-submittable assignment: {course_name}: {assignment['name']}"
-                    )
-                    is_added = True
-                    excluded += 1
-                    break
-            # Handle case where assignment has no due date and user has specified to not sync assignments with no due date
-            if (
-                assignment["due_at"] is None
-                and config["sync_no_due_date_assignments"] == False
-            ):
-                print(
-                    f"Excluding assignment with no due date: {course_name}: {assignment['name']}"
-                )
-                excluded += 1
-                is_added = True
-                break
-            # Handle case where assignment is locked and unlock date is more than 2 days in the future
-            if (
-                assignment["unlock_at"] is not None
-                and config["sync_locked_assignments"] == False
-                and assignment["unlock_at"]
-                > (datetime.now() + timedelta(days=3)).isoformat()
-            ):
-                print(
-                    f"Excluding assignment that is not yet unlocked: {course_name}: {assignment['name']}: {assignment['lock_explanation']}"
-                )
-                is_added = True
-                excluded += 1
-                break
-            # Handle case where assignment is locked and unlock date is empty
-            if (
-                assignment["locked_for_user"] == True
-                and assignment["unlock_at"] is None
-                and config["sync_locked_assignments"] == False
-            ):
-                print(
-                    f"Excluding assignment that is locked: {course_name}: {assignment['name']}: {assignment['lock_explanation']}"
-                )
-                is_added = True
-                excluded += 1
-                break
-        # Add assignment to Todoist if not already added - Ignore assignments that are already submitted
-        if not is_added:
-            if assignment["submission"]["workflow_state"] == "unsubmitted":
-                print(f"Adding assignment {course_name}: {assignment['name']}")
-                add_new_task(assignment, project_id)
-                new_added += 1
-                request_count += 1
-        # Update count of updated assignments (updated due date - already updated in Todoist)
-        if is_added and not is_synced:
-            updated += 1
-        # Update count of already synced assignments (already synced to Todoist, no updates)
-        if is_synced and is_added:
-            already_synced += 1
-        if new_added > max_added:
-            limit_reached = True
-        if limit_reached:
-            break
-        # Throttle requests to Todoist API to prevent rate limiting, sleep every 50 requests
-        if request_count % throttle_number == 0 and request_count > 1:
-            print(f"Current request count: {request_count}")
-            sleep()
-    if limit_reached:
-        print(
-            f"Reached Todoist API or configured limit. Not all tasks added. Please try again in 15 minutes."
-        )
-    print(f"  {'-'*52}")
-    print(f"Added to Todoist: {new_added}")
-    print(f"Due Date Updated In Todoist: {updated}")
-    print(f"Already Synced to Todoist: {already_synced}")
-    print(f"Excluded: {excluded}")
+# Returns a Todoist due date as the API sends it, e.g. 2026-02-01T23:59:00Z for a
+# datetime in UTC, from the date or datetime the TodoistAPI client parses it into
+def todoist_due_string(value):
+    if value is None or isinstance(value, str):
+        return value
+    return value.isoformat().replace("+00:00", "Z")
 
 
-# Adds a new task from a Canvas assignment object to Todoist under the
-# project corresponding to project_id
-def add_new_task(assignment, project_id):
-    global limit_reached
-    try:
-        due_datetime = assignment["due_at"]
-        deadline_date = None
+def is_all_day(value):
+    if isinstance(value, str):
+        return "T" not in value
+    return value is not None and not isinstance(value, datetime)
 
-        if due_datetime:
-            try:
-                parsed_date = datetime.strptime(due_datetime, "%Y-%m-%dT%H:%M:%SZ")
-                deadline_date = parsed_date.strftime("%Y-%m-%d")
-            except ValueError:
-                pass  # Skip if date is invalid
-
-        todoist_api.add_task(
-            content=f"[{assignment['name']}]({assignment['html_url']}) Due",
-            project_id=project_id,
-            due_datetime=due_datetime,
-            deadline_date=deadline_date,
-            labels=config["todoist_task_labels"],
-            priority=config["todoist_task_priority"],
-        )
 
-    except Exception as error:
-        print(
-            f"Error while adding task: {error}, likely due to rate limiting. Try again in 15 minutes"
-        )
-        limit_reached = True
+# Returns the YYYY-MM-DD date of a Todoist date, datetime or ISO string
+def todoist_date_string(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value[:10]
+    return value.isoformat()[:10]
 
 
-def canvas_assignment_stats():
-    print(f"  {'-'*52}")
-    print(" #     Current Canvas Assignment Statistics     #")
-    print(f"Total Assignments: {len(assignments)}")
-    graded_timestamps = []
-    submitted = 0
-    ignored_not_graded = 0
-    ignored_no_submission = 0
-    locked = 0
-    instructor_graded = 0
-    for assignment in assignments:
-        # Check for assignment graded_at dates, and if graded_at is not None, add to graded_timestamps list to report most recent grade update
-        if assignment["submission"]["graded_at"] is not None:
-            timestamp = datetime.strptime(
-                (assignment["submission"]["graded_at"]), "%Y-%m-%dT%H:%M:%SZ"
-            )
-            graded_timestamps.append(timestamp)
-        if assignment["graded_submissions_exist"] == True:
-            instructor_graded += 1
-        if assignment["submission"]["workflow_state"] != "unsubmitted":
-            submitted += 1
-        elif assignment["locked_for_user"] == True:
-            locked += 1
-        elif assignment["submission_types"][0] == "none":
-            ignored_no_submission += 1
-        elif assignment["submission_types"][0] == "not_graded":
-            ignored_not_graded += 1
-
-    print(f"Total Submitted: {submitted}")
-    print(f"Total Locked: {locked}")
-    print(f"Total Unsubmittable: {ignored_no_submission}")
-    print(f"Total Not_Graded: {ignored_not_graded}")
-    print(
-        f"Remaining (unlocked) Assignments: {(len(assignments)-submitted-ignored_not_graded-ignored_no_submission-locked)}"
-    )
-    print(f"\n Grading Statistics:")
-    print(f"Total Currently Graded: {max(instructor_graded,len(graded_timestamps))}")
-    latest_update = max(graded_timestamps, default=0)
-    if latest_update == 0:
-        print(f"Last Grade Update: Never")
-    else:
-        print(f"Last Grade Update: {aslocaltimestr(latest_update)}")
+# Converts a Todoist due date (a date, datetime or their ISO string) into UTC epoch
+# seconds, taking floating times as local time and all-day dates as midnight UTC
+def todoist_due_timestamp(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            if "T" in value:
+                value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+            else:
+                value = date.fromisoformat(value)
+        except ValueError:
+            return None
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    return calendar.timegm(value.timetuple())
 
 
-def update_task(assignment, task):
-    global limit_reached
+# Parses a Canvas ISO 8601 date into UTC epoch seconds, None if it is missing or invalid
+def parse_timestamp(value):
+    if value is None:
+        return None
     try:
-        due_datetime = assignment["due_at"]
-        deadline_date = None
+        return int(datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp())
+    except ValueError:
+        return None
 
-        if due_datetime:
-            try:
-                parsed_date = datetime.strptime(due_datetime, "%Y-%m-%dT%H:%M:%SZ")
-                deadline_date = parsed_date.strftime("%Y-%m-%d")
-            except ValueError:
-                pass
 
-        todoist_api.update_task(
-            task_id=task.id,
-            due_datetime=due_datetime,
-            deadline_date=deadline_date,
+# Yields the assignments of a course one page at a time. The raw JSON of each page is
+# parsed into Assignment records and dropped
+def iter_course_assignment_pages(ctx, course_id):
+    pager = CourseAssignmentPager(ctx, course_id)
+    response = canvas_get(ctx, pager.first_url(), params=param)
+    yield pager.page(response, first=True)
+    urls = pager.numbered_urls(response)
+    if urls:
+        with ThreadPoolExecutor(max_workers=page_workers(ctx)) as executor:
+            for response in executor.map(partial(canvas_get, ctx), urls):
+                yield pager.page(response)
+    while (url := pager.next_url(response)) is not None:
+        response = canvas_get(ctx, url)
+        yield pager.page(response)
+    pager.finish()
+
+
+# Pagination of the assignments of a course, shared by iter_course_assignment_pages()
+# and AsyncSyncEngine.course_pages(), which only send the requests. When the first page
+# numbers the others (see numbered_page_urls()) they are fetched in parallel, then the
+# next links are followed. The last page has one if the course grew meanwhile
+class CourseAssignmentPager:
+    def __init__(self, ctx, course_id):
+        self.ctx = ctx
+        self.course_id = course_id
+        self.loaded = 0
+
+    def first_url(self):
+        return f"{self.ctx.config['canvas_api_heading']}/api/v1/courses/{str(self.course_id)}/assignments"
+
+    # Parses a page of assignments. A 401 for the first page means the API key is wrong
+    def page(self, response, first=False):
+        if first and response.status_code == 401:
+            raise SyncError("Unauthorized; Check API Key")
+        response.raise_for_status()
+        page = [Assignment(data) for data in response.json()]
+        self.loaded += len(page)
+        return page
+
+    # URLs of the pages after the first to fetch in parallel, None if there are none
+    def numbered_urls(self, response):
+        return numbered_page_urls(response) if page_workers(self.ctx) > 1 else None
+
+    # The next link already carries the query parameters of the first request
+    def next_url(self, response):
+        link = response.links.get("next")
+        return link["url"] if link else None
+
+    def finish(self):
+        self.ctx.log(
+            f"Loaded {self.loaded} Assignments for Course {self.ctx.courses_id_name_dict[self.course_id]}"
         )
 
-    except Exception as error:
-        print(f"Error while updating task: {error}")
-        limit_reached = True
 
+# Number of pages of one course fetched from Canvas in parallel
+def page_workers(ctx):
+    return max(1, int(ctx.config.get("canvas_page_workers", canvas_page_workers)))
 
-# Credit to https://stackoverflow.com/questions/4563272/how-to-convert-a-utc-datetime-to-a-local-datetime-using-only-standard-library
-# This funciton is simply used for printing out graded and due dates in local time. It is not used for the task creation, as tasks MUST be created in UTC
-def utc_to_local(utc_dt):
-    return utc_dt.replace(tzinfo=timezone.utc).astimezone(tz=None)
 
+# URLs of pages 2 to last of a paginated Canvas response, built from its rel="last"
+# link. None when Canvas did not send a last link or does not number the pages (e.g.
+# bookmark pagination), or the response is the only page
+def numbered_page_urls(response):
+    last = response.links.get("last")
+    if last is None or "next" not in response.links:
+        return None
+    url = urlparse(last["url"])
+    query = parse_qs(url.query, keep_blank_values=True)
+    next_query = parse_qs(urlparse(response.links["next"]["url"]).query)
+    last_page = query.get("page", [""])[-1]
+    if not last_page.isdigit() or next_query.get("page") != ["2"]:
+        return None
+    return [
+        urlunparse(url._replace(query=urlencode(dict(query, page=n), doseq=True)))
+        for n in range(2, int(last_page) + 1)
+    ]
+
+
+# Raised when the Canvas GraphQL API cannot be used, e.g. because it is disabled
+class CanvasGraphQLError(Exception):
+    pass
+
+
+# Returns the backend used to fetch assignments, "rest" or "graphql" as set by
+# canvas_fetch_backend in config.json. GraphQL is not retried once it has failed
+def canvas_fetch_backend(ctx):
+    if ctx.graphql_unavailable:
+        return "rest"
+    return ctx.config.get("canvas_fetch_backend", "rest")
+
+
+# Yields the assignments of all selected courses from the Canvas GraphQL API. Each
+# request fetches the next page of every course that has more assignments, with one
+# aliased course field and cursor per course, so a sync needs as many requests as
+# the longest course has pages instead of one per course and page
+def iter_graphql_assignment_pages(ctx):
+    pager = GraphQLPager(ctx)
+    for course_ids, query in pager.requests():
+        try:
+            response = call_with_retry(
+                ctx.canvas_limiter,
+                ctx.canvas_session.post,
+                pager.url(),
+                json=query,
+                log=ctx.log,
+                metrics=ctx.metrics,
+            )
+            response.raise_for_status()
+            result = response.json()
+        except (requests.RequestException, ValueError) as error:
+            raise CanvasGraphQLError(error)
+        yield pager.page(result, course_ids)
 
-def aslocaltimestr(utc_dt):
-    return utc_to_local(utc_dt).strftime("%Y-%m-%d %I:%M%p")
 
+# Cursors of the GraphQL backend, shared by iter_graphql_assignment_pages() and
+# AsyncSyncEngine.graphql_pages(), which only send the requests
+class GraphQLPager:
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.cursors = {course_id: None for course_id in ctx.course_ids}
+        self.loaded = Counter()
 
-# Function for throttling/sleeping
-def sleep():
-    delay = (
-        randint(100, sleep_delay_max) / 1000
-    )  # random delay for throttling/rate limiting
-    print(f"Sleeping for {delay} seconds...")
-    time.sleep(delay)
+    def url(self):
+        return f"{self.ctx.config['canvas_api_heading']}/api/graphql"
+
+    # Yields the course ids and query of each request until all courses are loaded
+    def requests(self):
+        while self.cursors:
+            course_ids = list(self.cursors)[:canvas_graphql_courses]
+            yield course_ids, graphql_assignments_query(course_ids, self.cursors)
+
+    # Parses a GraphQL result into a page of assignments, and advances or removes the
+    # cursor of each course in it
+    def page(self, result, course_ids):
+        ctx = self.ctx
+        if result.get("errors") or not result.get("data"):
+            raise CanvasGraphQLError(
+                "; ".join(
+                    error.get("message", "") for error in result.get("errors") or []
+                )
+                or "no data returned"
+            )
+        page = []
+        for i, course_id in enumerate(course_ids):
+            course = result["data"].get(f"course{i}")
+            if course is None:
+                raise CanvasGraphQLError(f"course {course_id} not found")
+            # Keep the names of select_courses(), which are the user's nicknames that
+            # the projects are named after. GraphQL returns the real course name
+            ctx.courses_id_name_dict.setdefault(
+                course_id, re.sub(r"[^-a-zA-Z0-9._\s]", "", course["name"])
+            )
+            connection = course["assignmentsConnection"]
+            page.extend(
+                Assignment(graphql_assignment(node, course_id))
+                for node in connection["nodes"]
+            )
+            self.loaded[course_id] += len(connection["nodes"])
+            if connection["pageInfo"]["hasNextPage"]:
+                self.cursors[course_id] = connection["pageInfo"]["endCursor"]
+            else:
+                del self.cursors[course_id]
+                ctx.log(
+                    f"Loaded {self.loaded[course_id]} Assignments for Course {ctx.courses_id_name_dict[course_id]}"
+                )
+        return page
+
+
+# Builds the GraphQL request for the next page of assignments of the given courses
+def graphql_assignments_query(course_ids, cursors):
+    fields = []
+    for i, course_id in enumerate(course_ids):
+        fields.append(f"""
+  course{i}: course(id: "{course_id}") {{
+    name
+    assignmentsConnection(first: {canvas_graphql_page_size}, after: $after{i}) {{
+      nodes {{ ...SyncAssignment }}
+      pageInfo {{ hasNextPage endCursor }}
+    }}
+  }}""")
+    variables = ", ".join(f"$after{i}: String" for i in range(len(course_ids)))
+    query = f"""query SyncAssignments({variables}) {{{"".join(fields)}
+}}
+
+fragment SyncAssignment on Assignment {{
+  _id
+  name
+  htmlUrl
+  dueAt
+  unlockAt
+  lockInfo {{ isLocked }}
+  submissionTypes
+  gradedSubmissionsExist
+  submissionsConnection(first: 1) {{ nodes {{ state gradedAt }} }}
+}}"""
+    return {
+        "query": query,
+        "variables": {
+            f"after{i}": cursors[course_id] for i, course_id in enumerate(course_ids)
+        },
+    }
+
+
+# Converts a GraphQL assignment node into the fields of the REST API. Dates are
+# converted to UTC so they match the REST format
+def graphql_assignment(node, course_id):
+    submissions = node["submissionsConnection"]["nodes"]
+    submission = submissions[0] if submissions else {}
+    return {
+        "id": int(node["_id"]),
+        "course_id": course_id,
+        "name": node["name"],
+        "html_url": node["htmlUrl"],
+        "due_at": utc_date_string(node["dueAt"]),
+        "unlock_at": utc_date_string(node["unlockAt"]),
+        "locked_for_user": bool((node.get("lockInfo") or {}).get("isLocked")),
+        "submission_types": node.get("submissionTypes") or [],
+        "graded_submissions_exist": bool(node.get("gradedSubmissionsExist")),
+        "submission": {
+            "workflow_state": submission.get("state", "unsubmitted"),
+            "graded_at": utc_date_string(submission.get("gradedAt")),
+        },
+    }
+
+
+def utc_date_string(value):
+    timestamp = parse_timestamp(value)
+    if timestamp is None:
+        return value
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime(
+        "%Y-%m-%dT%H:%M:%SZ"
+    )
+
+
+# Yields the assignments of all selected courses from the configured backend. If the
+# GraphQL API fails on the first request, the REST API is used for this and later syncs
+def iter_assignment_pages(ctx):
+    if canvas_fetch_backend(ctx) == "graphql":
+        pages = iter_graphql_assignment_pages(ctx)
+        try:
+            first = next(pages, None)
+        except CanvasGraphQLError as error:
+            ctx.log(f"Canvas GraphQL API unavailable ({error}), falling back to REST")
+            ctx.graphql_unavailable = True
+        else:
+            if first is not None:
+                yield first
+            yield from pages
+            return
+    for course_id in ctx.course_ids:
+        yield from iter_course_assignment_pages(ctx, course_id)
+
+
+# Streams the assignments of all selected courses while they are downloaded. Courses are
+# fetched in parallel into a queue of at most canvas_stream_queue_pages pages, so memory
+# is bounded by the page size instead of the number of assignments, and assignments of
+# one course can be synced while the next is still loading. Adds every assignment to stats
+def stream_assignments(ctx, stats):
+    workers = max(1, int(ctx.config.get("canvas_fetch_workers", canvas_fetch_workers)))
+    pages = queue.Queue(maxsize=canvas_stream_queue_pages)
+    stop = threading.Event()
+
+    # Blocks until there is room in the queue, unless the consumer has stopped
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def produce(source):
+        try:
+            for page in source():
+                if stop.is_set():
+                    return
+                put(("page", page))
+            put(("done", None))
+        except Exception as error:
+            put(("error", error))
+
+    # GraphQL fetches all courses in one sequence of requests, REST one course per worker
+    if canvas_fetch_backend(ctx) == "graphql":
+        sources = [partial(iter_assignment_pages, ctx)]
+    else:
+        sources = [
+            partial(iter_course_assignment_pages, ctx, course_id)
+            for course_id in ctx.course_ids
+        ]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for source in sources:
+            executor.submit(produce, source)
+        try:
+            remaining = len(sources)
+            while remaining:
+                kind, value = pages.get()
+                if kind == "done":
+                    remaining -= 1
+                elif kind == "error":
+                    if isinstance(value, SyncError):
+                        raise value
+                    raise SyncError(
+                        f"Error while loading Assignments: {value}\nCheck or regenerate API Key and Canvas URL"
+                    )
+                else:
+                    for assignment in value:
+                        stats.add(assignment)
+                        yield assignment
+            ctx.log(f"Loaded {stats.total} Total Canvas Assignments")
+        finally:
+            stop.set()
+
+
+# Iterates over the course_ids list and loads all of the users assignments
+# for those classes. Courses are fetched in parallel through the shared Canvas
+# session and appended to the assignments list in course order, or all at once
+# when the GraphQL backend is selected
+def load_assignments(ctx):
+    workers = max(1, int(ctx.config.get("canvas_fetch_workers", canvas_fetch_workers)))
+    try:
+        if canvas_fetch_backend(ctx) == "graphql":
+            for page in iter_assignment_pages(ctx):
+                ctx.assignments.extend(page)
+        elif workers == 1:
+            for course_id in ctx.course_ids:
+                ctx.assignments.extend(fetch_course_assignments(ctx, course_id))
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for paginated in executor.map(
+                    partial(fetch_course_assignments, ctx), ctx.course_ids
+                ):
+                    ctx.assignments.extend(paginated)
+        ctx.log(f"Loaded {len(ctx.assignments)} Total Canvas Assignments")
+        return
+    except SyncError:
+        raise
+    except Exception as error:
+        raise SyncError(
+            f"Error while loading Assignments: {error}\nCheck or regenerate API Key and Canvas URL"
+        )
+
+
+# Loads the user's tasks from Todoist as TodoistTask records, limited to the course
+# projects or a label when todoist_task_scope is set in config.json. get_tasks()
+# returns an iterator of pages (lists of tasks). With todoist_incremental_sync the
+# tasks come from the local copy updated by sync_todoist_cache()
+def load_todoist_tasks(ctx):
+    scope = ctx.config.get("todoist_task_scope", "all")
+    if ctx.config.get("todoist_incremental_sync", False):
+        project_ids = set(course_project_ids(ctx))
+        label = scope_label(ctx) if scope == "label" else None
+        rows = ctx.sync_state.execute(
+            "SELECT id, content, project_id, due, due_all_day, deadline, labels, due_date FROM todoist_items"
+        )
+        for row in rows:
+            task_id, content, project_id, due, all_day, deadline, labels, due_date = row
+            if scope == "projects" and project_id not in project_ids:
+                continue
+            if scope == "label" and label not in json.loads(labels):
+                continue
+            ctx.todoist_tasks.append(
+                TodoistTask(
+                    task_id,
+                    content,
+                    project_id,
+                    due,
+                    bool(all_day),
+                    deadline,
+                    due_date,
+                )
+            )
+    else:
+        for task_filter in todoist_task_filters(ctx):
+            pages = ctx.todoist_api.get_tasks(**task_filter)
+            for page in iter(lambda: todoist_call(ctx, next, pages, None), None):
+                ctx.todoist_tasks.extend(todoist_task(task) for task in page)
+    ctx.log(f"Loaded {len(ctx.todoist_tasks)} Todoist Tasks")
+
+
+# get_tasks() arguments for each request needed to load the tasks in todoist_task_scope
+def todoist_task_filters(ctx):
+    scope = ctx.config.get("todoist_task_scope", "all")
+    if scope == "projects":
+        return [{"project_id": project_id} for project_id in course_project_ids(ctx)]
+    if scope == "label":
+        return [{"label": scope_label(ctx)}]
+    return [{}]
+
+
+# Ids of the existing Todoist projects of the selected courses
+def course_project_ids(ctx):
+    project_ids = []
+    for course_id in ctx.course_ids:
+        course_name = ctx.courses_id_name_dict.get(course_id)
+        if course_name in ctx.todoist_project_dict:
+            project_ids.append(ctx.todoist_project_dict[course_name])
+    return project_ids
+
+
+# Label that limits the loaded tasks when todoist_task_scope is "label". Defaults to
+# the first of the labels added to new tasks
+def scope_label(ctx):
+    label = ctx.config.get("todoist_scope_label") or next(
+        iter(ctx.config["todoist_task_labels"]), None
+    )
+    if label is None:
+        raise SyncError(
+            "todoist_task_scope is label, but neither todoist_scope_label nor todoist_task_labels is set"
+        )
+    return label
+
+
+# Brings the local copy of the user's Todoist tasks and projects up to date through the
+# Sync API. Only changes since the sync_token stored by the last call are downloaded;
+# the first call, or one after the token is reset, downloads everything
+def sync_todoist_cache(ctx):
+    response = todoist_call(
+        ctx,
+        ctx.todoist_session.post,
+        ctx.config.get("todoist_sync_url", todoist_sync_url),
+        data=todoist_cache_sync_params(ctx),
+    )
+    response.raise_for_status()
+    apply_todoist_sync(ctx, response.json())
+
+
+# Sync API read request for the changes since the stored sync_token
+def todoist_cache_sync_params(ctx):
+    row = ctx.sync_state.execute(
+        "SELECT value FROM todoist_sync WHERE key = 'sync_token'"
+    ).fetchone()
+    return {
+        "sync_token": row[0] if row is not None else "*",
+        "resource_types": json.dumps(["items", "projects"]),
+    }
+
+
+# Applies a Sync API read result to the local copy of tasks and projects
+def apply_todoist_sync(ctx, result):
+    db = ctx.sync_state
+    if result.get("full_sync"):
+        db.execute("DELETE FROM todoist_items")
+        db.execute("DELETE FROM todoist_projects")
+    items = result.get("items", [])
+    for item in items:
+        # Completed tasks are not returned by the REST API either
+        if item.get("is_deleted") or item.get("checked"):
+            db.execute("DELETE FROM todoist_items WHERE id = ?", (item["id"],))
+            continue
+        due = item["due"]["date"] if item.get("due") else None
+        deadline = item["deadline"]["date"] if item.get("deadline") else None
+        db.execute(
+            "INSERT OR REPLACE INTO todoist_items VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                item["id"],
+                item["content"],
+                item["project_id"],
+                todoist_due_timestamp(due),
+                is_all_day(due),
+                todoist_date_string(deadline),
+                json.dumps(item.get("labels", [])),
+                due,
+            ),
+        )
+    projects = result.get("projects", [])
+    for project in projects:
+        if project.get("is_deleted") or project.get("is_archived"):
+            db.execute("DELETE FROM todoist_projects WHERE id = ?", (project["id"],))
+        else:
+            db.execute(
+                "INSERT OR REPLACE INTO todoist_projects VALUES (?, ?)",
+                (project["id"], project["name"]),
+            )
+    db.execute(
+        "INSERT OR REPLACE INTO todoist_sync VALUES ('sync_token', ?)",
+        (result["sync_token"],),
+    )
+    db.commit()
+    ctx.log(
+        f"Todoist {'full' if result.get('full_sync') else 'incremental'} sync: {len(items)} changed tasks, {len(projects)} changed projects"
+    )
+
+
+# Builds the task content string used to identify a Canvas assignment in Todoist
+def task_content(assignment):
+    return f"[{assignment.name}]({assignment.html_url}) Due"
+
+
+# Normalizes task content for matching so that whitespace and case differences are ignored
+def normalize_content(content):
+    return " ".join(content.split()).casefold()
+
+
+# Extracts the Canvas assignment URL embedded in the markdown link of a task's content
+def extract_canvas_url(content):
+    match = re.search(r"\]\((https?://[^)\s]+)\)", content)
+    if match is None:
+        return None
+    return normalize_url(match.group(1))
+
+
+def normalize_url(url):
+    return url.strip().rstrip("/").lower()
+
+
+# Adds a task to the lookup tables. The first task seen for a URL wins so that
+# existing duplicates do not shadow each other between runs.
+def index_task(ctx, task):
+    todoist_task_index = ctx.todoist_task_index
+    todoist_task_index["by_content"].setdefault(
+        (task.project_id, normalize_content(task.content)), task
+    )
+    url = extract_canvas_url(task.content)
+    if url is not None:
+        todoist_task_index["by_url"].setdefault(url, task)
+    todoist_task_index["by_id"][task.id] = task
+
+
+# Builds the task index once after loading Todoist tasks so that each assignment
+# is matched with a single lookup instead of a scan over all tasks
+def build_todoist_task_index(ctx):
+    for lookup in ctx.todoist_task_index.values():
+        lookup.clear()
+    for task in ctx.todoist_tasks:
+        index_task(ctx, task)
+
+
+# Finds the Todoist task for an assignment. Matches on project and content first,
+# then falls back to the Canvas URL to find tasks that were renamed or moved to
+# another project
+def find_task(ctx, assignment, project_id):
+    task = ctx.todoist_task_index["by_content"].get(
+        (project_id, normalize_content(task_content(assignment)))
+    )
+    if task is not None:
+        return task, False
+    task = ctx.todoist_task_index["by_url"].get(normalize_url(assignment.html_url))
+    return task, task is not None
+
+
+# Loads all user projects from Todoist. get_projects() returns an iterator of pages (lists of projects).
+# With todoist_incremental_sync the local copy of tasks and projects is synced first
+# and the projects are read from it
+def load_todoist_projects(ctx):
+    if ctx.config.get("todoist_incremental_sync", False):
+        sync_todoist_cache(ctx)
+        load_cached_todoist_projects(ctx)
+    else:
+        pages = ctx.todoist_api.get_projects()
+        for page in iter(lambda: todoist_call(ctx, next, pages, None), None):
+            for project in page:
+                ctx.todoist_project_dict[project.name] = project.id
+    ctx.log(f"Loaded {len(ctx.todoist_project_dict)} Todoist Projects")
+
+
+def load_cached_todoist_projects(ctx):
+    for project_id, name in ctx.sync_state.execute(
+        "SELECT id, name FROM todoist_projects"
+    ):
+        ctx.todoist_project_dict[name] = project_id
+
+
+# Checks to see if the user has a project matching their course names, if there
+# is not a new project will be created
+def create_todoist_projects(ctx):
+    for course_name in missing_todoist_projects(ctx):
+        project = todoist_call(ctx, ctx.todoist_api.add_project, course_name)
+        todoist_project_created(ctx, project)
+
+
+# Yields the names of the course projects that do not exist in Todoist yet, for both
+# engines. With --dry-run they are only logged
+def missing_todoist_projects(ctx):
+    for course_id in ctx.course_ids:
+        course_name = ctx.courses_id_name_dict[course_id]
+        if course_name in ctx.todoist_project_dict:
+            ctx.log(f"Project {course_name} exists")
+        elif ctx.dry_run:
+            ctx.log(f"Project {course_name} would be created")
+            ctx.todoist_project_dict[course_name] = None
+        else:
+            yield course_name
+
+
+# Remembers a project created by create_todoist_projects() for either engine
+def todoist_project_created(ctx, project):
+    ctx.log(f"Project {project.name} created")
+    ctx.todoist_project_dict[project.name] = project.id
+
+
+# Transfers over assignments from canvas over to Todoist, the method Checks
+# to make sure the assignment has not already been transferred to prevent overlap.
+# The sync is planned first (see plan_sync()), then the planned adds and updates are
+# written to the sync journal and sent. Writes left in the journal by a run that
+# stopped at the Todoist rate limit are sent first, with the same idempotency keys.
+# Adds and updates are sent as Sync API command batches unless todoist_batch_writes
+# is set to false in config.json, in which case each write is a REST call.
+# assignments defaults to the loaded ctx.assignments, see stream_assignments()
+def transfer_assignments_to_todoist(ctx, assignments=None):
+    counts = sync_counts()
+    if assignments is None:
+        assignments = ctx.assignments
+    if ctx.dry_run:
+        print_sync_plan(ctx, assignments, counts)
+        return counts
+    writer = (
+        TodoistBatchWriter(ctx)
+        if ctx.config.get("todoist_batch_writes", True)
+        else None
+    )
+    # Send what was queued and keep the sync state even if streaming fails part way
+    try:
+        journal = load_sync_journal(ctx)
+        if journal:
+            ctx.log(f"Resuming {len(journal)} Todoist writes left by the last run")
+            execute_sync_plan(ctx, journal, writer, counts)
+            if writer is not None:
+                writer.flush()
+        if not ctx.limit_reached:
+            resumed = {operation["assignment_id"] for operation in journal}
+            operations = plan_sync(ctx, assignments, counts, resumed=resumed)
+            # A loaded plan is journaled as a whole before anything is sent, a streamed
+            # plan one write at a time
+            if assignments is ctx.assignments:
+                operations = list(operations)
+                journal_operations(ctx, operations)
+            execute_sync_plan(ctx, operations, writer, counts)
+    finally:
+        if writer is not None:
+            writer.flush()
+            counts["failed"] += len(writer.failed)
+        ctx.sync_state.commit()
+    finish_transfer(ctx, counts)
+    return counts
+
+
+def sync_counts():
+    return {
+        "added": 0,
+        "updated": 0,
+        "avoided": 0,
+        "synced": 0,
+        "excluded": 0,
+        "failed": 0,
+    }
+
+
+# Keeps the counts of a transfer and logs the summary
+def finish_transfer(ctx, counts):
+    ctx.counts = counts
+    if ctx.limit_reached:
+        ctx.log(
+            f"Reached Todoist API limit and retries were exhausted. Not all tasks added. Please try again in 15 minutes."
+        )
+    log_sync_counts(ctx, counts)
+
+
+def log_sync_counts(ctx, counts):
+    ctx.log(f"  {'-'*52}")
+    ctx.log(f"Added to Todoist: {counts['added']}")
+    ctx.log(f"Due Date Updated In Todoist: {counts['updated']}")
+    ctx.log(f"Redundant Updates Avoided: {counts['avoided']}")
+    ctx.log(f"Already Synced to Todoist: {counts['synced']}")
+    ctx.log(f"Excluded: {counts['excluded']}")
+    if counts["failed"]:
+        ctx.log(f"Failed: {counts['failed']}")
+
+
+# Plans the sync of assignments, yielding an operation for every assignment that needs
+# a Todoist write or a sync state record, in order. "add" and "update" operations carry
+# the Sync API command arguments and a uuid (plus a temp_id for adds) that make sending
+# them again idempotent, "synced" and "skip" operations only record the sync state.
+# Assignments that have not changed since they were last synced are only counted, unless
+# their id is in resumed, the assignments already counted by writes resumed from the
+# journal. synced_state and rules may be passed in when one sync is planned in parts
+def plan_sync(ctx, assignments, counts, synced_state=None, rules=None, resumed=()):
+    if synced_state is None:
+        synced_state = load_sync_state(ctx)
+    if rules is None:
+        rules = compile_exclusion_rules(ctx)
+    for assignment in exclude_assignments(ctx, assignments, rules, counts):
+        course_name = ctx.courses_id_name_dict[assignment.course_id]
+        project_id = ctx.todoist_project_dict[course_name]
+
+        # Skip assignments that have not changed since they were last synced
+        fingerprint = assignment_fingerprint(assignment, project_id)
+        state = synced_state.get(assignment.id)
+        if state is not None and state[1] == fingerprint:
+            # Submitted assignments that were never added are not counted as synced
+            if state[0] is not None and assignment.id not in resumed:
+                counts["synced"] += 1
+            continue
+
+        operation = {
+            "assignment_id": assignment.id,
+            "course": course_name,
+            "name": assignment.name,
+            "fingerprint": fingerprint,
+        }
+        # Go straight to the previously synced task if it still exists, otherwise check if
+        # assignment is already added to Todoist with same name and within the same Project
+        task = (
+            ctx.todoist_task_index["by_id"].get(state[0]) if state is not None else None
+        )
+        is_moved = False
+        if task is None:
+            task, is_moved = find_task(ctx, assignment, project_id)
+        if task is not None:
+            if is_moved:
+                ctx.log(
+                    f"Found renamed or moved task for assignment: {course_name}:{assignment.name}"
+                )
+            # Update the due date if the task does not have one or it differs from the
+            # assignment. Ignore updates if assignment has no due date and already synced
+            if assignment.due is not None and not due_matches(assignment, task):
+                operation.update(
+                    action="update",
+                    uuid=str(uuid.uuid4()),
+                    task_id=task.id,
+                    args=update_task_args(assignment, task),
+                )
+            else:
+                # Count dues that only differ in format, timezone, seconds or being
+                # all-day, which were updated when dues were compared as strings
+                operation.update(
+                    action="synced",
+                    task_id=task.id,
+                    avoided=assignment.due is not None
+                    and task.due_date != assignment.due_at,
+                )
+        # Add assignment to Todoist if not already added - Ignore assignments that are already submitted
+        elif assignment.workflow_state == "unsubmitted":
+            operation.update(
+                action="add",
+                uuid=str(uuid.uuid4()),
+                temp_id=str(uuid.uuid4()),
+                args=add_task_args(ctx, assignment, project_id),
+            )
+        # Remember submitted assignments that were not added so they are skipped until they change.
+        # Excluded assignments are not recorded as they depend on config and the current date
+        else:
+            operation["action"] = "skip"
+        yield operation
+
+
+# Applies planned operations. Adds and updates that are not journaled yet are
+# journaled before they are queued, and leave the journal once Todoist has applied them
+# or rejected them. Stops when the Todoist rate limit is reached, leaving the rest of
+# the journal for the next run
+def execute_sync_plan(ctx, operations, writer, counts):
+    for operation in operations:
+        action = operation["action"]
+        if action == "synced":
+            if operation["avoided"]:
+                counts["avoided"] += 1
+            write_succeeded(ctx, counts, "synced", operation, operation["task_id"])
+        elif action == "skip":
+            record_sync_state(
+                ctx, operation["assignment_id"], None, operation["fingerprint"]
+            )
+        else:
+            if "position" not in operation:
+                journal_operations(ctx, [operation])
+            if action == "add":
+                ctx.log(f"Adding assignment {operation['course']}: {operation['name']}")
+            else:
+                ctx.log(
+                    f"Updating assignment due date: {operation['course']}:{operation['name']} to {operation['args']['due']['date']}"
+                )
+            counter = "added" if action == "add" else "updated"
+            on_success = partial(write_succeeded, ctx, counts, counter, operation)
+            if writer is not None:
+                writer.queue(operation, on_success)
+            else:
+                task_id = send_operation(ctx, operation)
+                if task_id is not None:
+                    on_success(task_id)
+                elif not ctx.limit_reached:
+                    counts["failed"] += 1
+                    remove_from_journal(ctx, operation)
+        if ctx.limit_reached:
+            break
+
+
+# Logs the operations of the sync plan without sending anything to Todoist or changing
+# the sync state, for --dry-run
+def print_sync_plan(ctx, assignments, counts):
+    for operation in load_sync_journal(ctx):
+        ctx.log(f"Would resume: {describe_operation(operation)}")
+    for operation in plan_sync(ctx, assignments, counts):
+        if operation["action"] in ("add", "update"):
+            ctx.log(f"Would {describe_operation(operation)}")
+        if operation["action"] == "add":
+            counts["added"] += 1
+        elif operation["action"] == "update":
+            counts["updated"] += 1
+        elif operation["action"] == "synced":
+            counts["synced"] += 1
+            counts["avoided"] += operation["avoided"]
+    ctx.counts = counts
+    ctx.log("Dry run, nothing was sent to Todoist. Planned changes:")
+    log_sync_counts(ctx, counts)
+
+
+def describe_operation(operation):
+    due = (operation["args"].get("due") or {}).get("date")
+    return (
+        f"{operation['action']} {operation['course']}: {operation['name']} (due {due})"
+    )
+
+
+# Writes planned adds and updates to the sync journal in sync_state.db, where they stay
+# until Todoist has applied or rejected them. The journal is committed before every
+# request that sends them, see TodoistBatchWriter.flush() and send_operation()
+def journal_operations(ctx, operations):
+    for operation in operations:
+        if operation["action"] in ("add", "update"):
+            cursor = ctx.sync_state.execute(
+                "INSERT INTO sync_journal (operation) VALUES (?)",
+                (json.dumps(operation),),
+            )
+            operation["position"] = cursor.lastrowid
+
+
+# Loads the operations left in the sync journal, in the order they were planned
+def load_sync_journal(ctx):
+    operations = []
+    rows = ctx.sync_state.execute(
+        "SELECT position, operation FROM sync_journal ORDER BY position"
+    )
+    for position, operation in rows:
+        operation = json.loads(operation)
+        operation["position"] = position
+        operations.append(operation)
+    return operations
+
+
+def remove_from_journal(ctx, operation):
+    if "position" in operation:
+        ctx.sync_state.execute(
+            "DELETE FROM sync_journal WHERE position = ?", (operation["position"],)
+        )
+
+
+# Counts a write that has been applied in Todoist, remembers it in the sync state and
+# removes it from the journal. Added tasks are indexed so the assignment is not added
+# again by the same run
+def write_succeeded(ctx, counts, counter, operation, task_id):
+    counts[counter] += 1
+    record_sync_state(
+        ctx, operation["assignment_id"], task_id, operation["fingerprint"]
+    )
+    remove_from_journal(ctx, operation)
+    if operation["action"] == "update":
+        update_indexed_due(ctx, task_id, operation["args"])
+    if operation["action"] == "add" and task_id is not None:
+        args = operation["args"]
+        due = (args.get("due") or {}).get("date")
+        index_task(
+            ctx,
+            TodoistTask(
+                task_id,
+                args["content"],
+                args["project_id"],
+                todoist_due_timestamp(due),
+                is_all_day(due),
+                (args.get("deadline") or {}).get("date"),
+                due,
+            ),
+        )
+
+
+# Applies an update to the indexed task, so later syncs of the same run or listener
+# compare against the due date Todoist now has
+def update_indexed_due(ctx, task_id, args):
+    task = ctx.todoist_task_index["by_id"].get(task_id)
+    if task is None:
+        return
+    due = args["due"]["date"]
+    task.due = todoist_due_timestamp(due)
+    task.due_all_day = is_all_day(due)
+    task.due_date = due
+    if "deadline" in args:
+        task.deadline = args["deadline"]["date"]
+
+
+# Compiles the exclusion settings of config.json into a list of (test, description,
+# show_lock_explanation) rules. Cutoff dates are computed once per sync. Besides the
+# sync_*_assignments flags, exclusion_rules may list rules with a single key each:
+#   {"include_courses": [...]} / {"exclude_courses": [...]}  course ids or names
+#   {"include_name": "regex"} / {"exclude_name": "regex"}    searched in the assignment name
+#   {"due_within_days": N}  excludes assignments due more than N days from now
+def compile_exclusion_rules(ctx):
+    config = ctx.config
+    now = time.time()
+    rules = []
+    # Handle case where assignment is not graded
+    if config["sync_null_assignments"] == False:
+        rules.append(
+            (
+                lambda assignment: assignment.submission_type
+                in ("not_graded", "none", "on_paper"),
+                "ungraded/non-submittable assignment",
+                False,
+            )
+        )
+    # Handle case where assignment has no due date and user has specified to not sync assignments with no due date
+    if config["sync_no_due_date_assignments"] == False:
+        rules.append(
+            (
+                lambda assignment: assignment.due is None,
+                "assignment with no due date",
+                False,
+            )
+        )
+    if config["sync_locked_assignments"] == False:
+        # Handle case where assignment is locked and unlock date is more than 3 days in the future
+        unlock_cutoff = now + timedelta(days=3).total_seconds()
+        rules.append(
+            (
+                lambda assignment: assignment.unlock_at is not None
+                and assignment.unlock_at > unlock_cutoff,
+                "assignment that is not yet unlocked",
+                True,
+            )
+        )
+        # Handle case where assignment is locked and unlock date is empty
+        rules.append(
+            (
+                lambda assignment: assignment.locked_for_user == True
+                and assignment.unlock_at is None,
+                "assignment that is locked",
+                True,
+            )
+        )
+    for rule in config.get("exclusion_rules", []):
+        if not isinstance(rule, dict) or len(rule) != 1:
+            raise SyncError(f"Invalid exclusion rule {rule}: expected a single key")
+        ((kind, value),) = rule.items()
+        if kind in ("include_courses", "exclude_courses"):
+            if not isinstance(value, list) or not all(
+                isinstance(course, (int, str)) for course in value
+            ):
+                raise SyncError(
+                    f"Invalid exclusion rule {rule}: expected a list of course ids or names"
+                )
+            course_ids = rule_course_ids(ctx, value)
+            include = kind == "include_courses"
+            rules.append(
+                (
+                    lambda assignment, course_ids=course_ids, include=include: (
+                        assignment.course_id in course_ids
+                    )
+                    != include,
+                    (
+                        "assignment of a course that is not included"
+                        if include
+                        else "assignment of an excluded course"
+                    ),
+                    False,
+                )
+            )
+        elif kind in ("include_name", "exclude_name"):
+            try:
+                pattern = re.compile(value)
+            except (re.error, TypeError) as error:
+                raise SyncError(f"Invalid exclusion rule {rule}: {error}")
+            include = kind == "include_name"
+            rules.append(
+                (
+                    lambda assignment, pattern=pattern, include=include: (
+                        pattern.search(assignment.name) is not None
+                    )
+                    != include,
+                    f"assignment {'not ' if include else ''}matching {value!r}",
+                    False,
+                )
+            )
+        elif kind == "due_within_days":
+            try:
+                due_cutoff = now + timedelta(days=float(value)).total_seconds()
+            except (ValueError, TypeError, OverflowError) as error:
+                raise SyncError(f"Invalid exclusion rule {rule}: {error}")
+            rules.append(
+                (
+                    lambda assignment, due_cutoff=due_cutoff: assignment.due is not None
+                    and assignment.due > due_cutoff,
+                    f"assignment due in more than {value} days",
+                    False,
+                )
+            )
+        else:
+            raise SyncError(f"Unknown exclusion rule {kind}")
+    return rules
+
+
+# Course ids for the courses of an include_courses or exclude_courses rule, given by id or name
+def rule_course_ids(ctx, courses):
+    names = {name: course_id for course_id, name in ctx.courses_id_name_dict.items()}
+    course_ids = set()
+    for course in courses:
+        if isinstance(course, int) or str(course).isdigit():
+            course_ids.add(int(course))
+        elif course in names:
+            course_ids.add(names[course])
+        else:
+            ctx.log(f"Exclusion rule course {course} is not one of your courses")
+    return course_ids
+
+
+# Yields the assignments that are not excluded by any rule, so matching only sees the
+# assignments that are synced. Exclusions are counted and logged
+def exclude_assignments(ctx, assignments, rules, counts):
+    for assignment in assignments:
+        for test, description, show_lock_explanation in rules:
+            if test(assignment):
+                course_name = ctx.courses_id_name_dict[assignment.course_id]
+                message = f"Excluding {description}: {course_name}: {assignment.name}"
+                if show_lock_explanation:
+                    message += f": {assignment.lock_explanation}"
+                ctx.log(message)
+                counts["excluded"] += 1
+                break
+        else:
+            yield assignment
+
+
+# Returns the due datetime and deadline date to send to Todoist for an assignment
+def due_fields(assignment):
+    return assignment.due_at, assignment_deadline(assignment)
+
+
+# The deadline date of an assignment, the UTC date it is due. None if the due date is
+# missing or invalid
+def assignment_deadline(assignment):
+    if assignment.due is None:
+        return None
+    return datetime.fromtimestamp(assignment.due, timezone.utc).strftime("%Y-%m-%d")
+
+
+# Checks if the due date and deadline of a task already match the assignment. Dues are
+# compared as UTC instants to the minute, so differences in format or timezone and
+# seconds dropped by Todoist are not changes. An all-day due matches if it is on the
+# day the assignment is due, in UTC or local time
+def due_matches(assignment, task):
+    if task.due is None:
+        return False
+    if task.due_all_day:
+        day = datetime.fromtimestamp(task.due, timezone.utc).strftime("%Y-%m-%d")
+        local_day = utc_to_local(
+            datetime.fromtimestamp(assignment.due, timezone.utc)
+        ).strftime("%Y-%m-%d")
+        if day not in (assignment_deadline(assignment), local_day):
+            return False
+    elif task.due // 60 != assignment.due // 60:
+        return False
+    return task.deadline == assignment_deadline(assignment)
+
+
+# Sync API arguments of the command that adds a task for an assignment
+def add_task_args(ctx, assignment, project_id):
+    due_datetime, deadline_date = due_fields(assignment)
+    args = {
+        "content": task_content(assignment),
+        "project_id": project_id,
+        "labels": ctx.config["todoist_task_labels"],
+        "priority": ctx.config["todoist_task_priority"],
+    }
+    if due_datetime:
+        args["due"] = {"date": due_datetime}
+    if deadline_date:
+        args["deadline"] = {"date": deadline_date}
+    return args
+
+
+# Sync API arguments of the command that updates the due date of a task
+def update_task_args(assignment, task):
+    due_datetime, deadline_date = due_fields(assignment)
+    args = {"id": task.id, "due": {"date": due_datetime}}
+    if deadline_date:
+        args["deadline"] = {"date": deadline_date}
+    return args
+
+
+# Sends an add or update operation as a REST call, with the operation's uuid as the
+# X-Request-Id so a repeated request is applied only once. Returns the task id, or
+# None on error
+def send_operation(ctx, operation):
+    args = operation["args"]
+    due_datetime, deadline_date = rest_due_fields(args)
+    ctx.sync_state.commit()  # Keep the journal entry if the run stops during the request
+    ctx.todoist_request_id = operation["uuid"]
+    try:
+        if operation["action"] == "add":
+            task = todoist_call(
+                ctx,
+                ctx.todoist_api.add_task,
+                content=args["content"],
+                project_id=args["project_id"],
+                due_datetime=due_datetime,
+                deadline_date=deadline_date,
+                labels=args["labels"],
+                priority=args["priority"],
+            )
+            return task.id
+        todoist_call(
+            ctx,
+            ctx.todoist_api.update_task,
+            task_id=args["id"],
+            due_datetime=due_datetime,
+            deadline_date=deadline_date,
+        )
+        return args["id"]
+
+    except RateLimitExceeded as error:
+        ctx.log(f"Error while sending task: {error}. Try again in 15 minutes")
+        ctx.limit_reached = True
+    except Exception as error:
+        ctx.log(f"Error while sending task {operation['name']}: {error}")
+    finally:
+        ctx.todoist_request_id = None
+
+
+# The due datetime and deadline date of Sync API arguments as the TodoistAPI client
+# takes them
+def rest_due_fields(args):
+    due_datetime = (args.get("due") or {}).get("date")
+    deadline_date = (args.get("deadline") or {}).get("date")
+    return (
+        parse_due_datetime(due_datetime),
+        date.fromisoformat(deadline_date) if deadline_date else None,
+    )
+
+
+def parse_due_datetime(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+# Request ids for the TodoistAPI client: the uuid of the operation being sent, if any
+def todoist_request_id(ctx):
+    return ctx.todoist_request_id or str(uuid.uuid4())
+
+
+# Collects task adds and updates and sends them to the Todoist Sync API as command
+# batches. Every command carries the uuid of its operation, so a batch that is retried
+# or resumed from the journal is applied only once, and adds carry a temp_id that the
+# response maps to the new task id. on_success is called with the task id of each
+# command that was applied
+class TodoistBatchWriter:
+    def __init__(self, ctx, batch_size=todoist_batch_size):
+        self.ctx = ctx
+        self.batch_size = batch_size
+        self.pending = []  # (operation, on_success)
+        self.failed = []  # (operation, error)
+
+    def queue(self, operation, on_success):
+        self.pending.append((operation, on_success))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    # Rejected operations are not sent again, so they leave the journal
+    def fail(self, operation, error):
+        self.failed.append((operation, error))
+        remove_from_journal(self.ctx, operation)
+
+    # Sends all pending commands. Errors are reported per command and mapped back to the
+    # assignment that caused them
+    def flush(self):
+        ctx = self.ctx
+        while self.pending:
+            batch = self.pending[: self.batch_size]
+            del self.pending[: self.batch_size]
+            ctx.sync_state.commit()  # The journal must hold every command that is sent
+            commands = [sync_command(operation) for operation, _ in batch]
+            try:
+                response = todoist_call(
+                    ctx,
+                    ctx.todoist_session.post,
+                    ctx.config.get("todoist_sync_url", todoist_sync_url),
+                    data={"commands": json.dumps(commands)},
+                )
+                response.raise_for_status()
+                result = response.json()
+            except RateLimitExceeded as error:
+                ctx.log(
+                    f"Error while sending tasks to Todoist: {error}. Try again in 15 minutes"
+                )
+                ctx.limit_reached = True
+                self.pending.clear()
+                return
+            except Exception as error:
+                ctx.log(f"Error while sending tasks to Todoist: {error}")
+                for operation, _ in batch:
+                    self.fail(operation, str(error))
+                continue
+            self.apply_result(batch, result)
+
+    # Maps the sync_status of every command back to its operation
+    def apply_result(self, batch, result):
+        for operation, on_success in batch:
+            status = result.get("sync_status", {}).get(operation["uuid"])
+            if status == "ok":
+                task_id = result.get("temp_id_mapping", {}).get(
+                    operation.get("temp_id"), operation["args"].get("id")
+                )
+                on_success(task_id)
+            else:
+                error = status.get("error") if isinstance(status, dict) else status
+                self.ctx.log(f"Error while syncing task {operation['name']}: {error}")
+                self.fail(operation, error)
+
+
+# Sync API command for an add or update operation
+def sync_command(operation):
+    command = {
+        "type": "item_add" if operation["action"] == "add" else "item_update",
+        "uuid": operation["uuid"],
+        "args": operation["args"],
+    }
+    if "temp_id" in operation:
+        command["temp_id"] = operation["temp_id"]
+    return command
+
+
+# Running totals for the Canvas assignment statistics, so they can be collected while
+# assignments are streamed without keeping them in memory
+class AssignmentStats:
+    def __init__(self):
+        self.total = 0
+        self.submitted = 0
+        self.locked = 0
+        self.ignored_no_submission = 0
+        self.ignored_not_graded = 0
+        self.instructor_graded = 0
+        self.graded = 0
+        self.latest_grade = None
+        self.next_due = None  # Earliest upcoming due date of an unsubmitted assignment
+        self.now = time.time()
+
+    def add(self, assignment):
+        self.total += 1
+        # Keep the most recent graded_at date to report the last grade update
+        graded_at = assignment.graded_at
+        if graded_at is not None:
+            self.graded += 1
+            if self.latest_grade is None or graded_at > self.latest_grade:
+                self.latest_grade = graded_at
+        if assignment.graded_submissions_exist == True:
+            self.instructor_graded += 1
+        if assignment.workflow_state != "unsubmitted":
+            self.submitted += 1
+            return
+        due = assignment.due
+        if due is not None and due >= self.now:
+            if self.next_due is None or due < self.next_due:
+                self.next_due = due
+        if assignment.locked_for_user == True:
+            self.locked += 1
+        elif assignment.submission_type == "none":
+            self.ignored_no_submission += 1
+        elif assignment.submission_type == "not_graded":
+            self.ignored_not_graded += 1
+
+
+# Logs the Canvas assignment statistics. stats is collected from ctx.assignments unless
+# it was already collected while streaming
+def canvas_assignment_stats(ctx, stats=None):
+    if stats is None:
+        stats = AssignmentStats()
+        for assignment in ctx.assignments:
+            stats.add(assignment)
+    ctx.assignment_stats = stats
+    ctx.log(f"  {'-'*52}")
+    ctx.log(" #     Current Canvas Assignment Statistics     #")
+    ctx.log(f"Total Assignments: {stats.total}")
+    ctx.log(f"Total Submitted: {stats.submitted}")
+    ctx.log(f"Total Locked: {stats.locked}")
+    ctx.log(f"Total Unsubmittable: {stats.ignored_no_submission}")
+    ctx.log(f"Total Not_Graded: {stats.ignored_not_graded}")
+    ctx.log(
+        f"Remaining (unlocked) Assignments: {(stats.total-stats.submitted-stats.ignored_not_graded-stats.ignored_no_submission-stats.locked)}"
+    )
+    ctx.log(f"\n Grading Statistics:")
+    ctx.log(f"Total Currently Graded: {max(stats.instructor_graded,stats.graded)}")
+    if stats.latest_grade is None:
+        ctx.log(f"Last Grade Update: Never")
+    else:
+        ctx.log(
+            f"Last Grade Update: {aslocaltimestr(datetime.fromtimestamp(stats.latest_grade, timezone.utc))}"
+        )
+
+
+# Credit to https://stackoverflow.com/questions/4563272/how-to-convert-a-utc-datetime-to-a-local-datetime-using-only-standard-library
+# This funciton is simply used for printing out graded and due dates in local time. It is not used for the task creation, as tasks MUST be created in UTC
+def utc_to_local(utc_dt):
+    return utc_dt.replace(tzinfo=timezone.utc).astimezone(tz=None)
+
+
+def aslocaltimestr(utc_dt):
+    return utc_to_local(utc_dt).strftime("%Y-%m-%d %I:%M%p")
+
+
+# Raised when a request is still rate limited after max_retries attempts
+class RateLimitExceeded(Exception):
+    pass
+
+
+# Token bucket shared by all requests to one service. Holds up to capacity tokens,
+# refilled evenly over per_seconds, and can be paused when the service asks us to wait
+class RateLimiter:
+    def __init__(self, name, capacity, per_seconds):
+        self.name = name
+        self.capacity = capacity
+        self.rate = capacity / per_seconds
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    # Takes a token and returns the number of seconds to wait before sending the request
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate, self.paused_until - now)
+
+    # Waits for a token and returns the number of seconds slept
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    # Holds back all requests to the service for the given number of seconds
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    # Slows down when Canvas reports that its quota is running low
+    def observe(self, response):
+        remaining = response.headers.get("X-Rate-Limit-Remaining")
+        if remaining is None:
+            return
+        try:
+            remaining = float(remaining)
+        except ValueError:
+            return
+        # Wait long enough for the missing quota to cover a few more requests
+        if remaining < canvas_low_water:
+            self.pause((canvas_low_water - remaining) / canvas_request_cost / self.rate)
+
+
+# Returns the rate limiter of a service for an API token, creating it on first use
+def get_rate_limiter(name, token, limit):
+    with rate_limiters_lock:
+        if (name, token) not in rate_limiters:
+            rate_limiters[(name, token)] = RateLimiter(name, *limit)
+        return rate_limiters[(name, token)]
+
+
+# Checks if a response asks us to slow down or is a transient server error.
+# Canvas answers throttled requests with 403 Rate Limit Exceeded instead of 429
+def is_retryable(response):
+    if response.status_code in (429, 502, 503, 504):
+        return True
+    if response.status_code == 403:
+        try:
+            return "Rate Limit Exceeded" in response.text
+        except Exception:
+            return False
+    return False
+
+
+# Returns the number of seconds from a Retry-After header, which may be seconds or an HTTP date
+def retry_after(response):
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(
+            0.0,
+            (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(),
+        )
+    except (TypeError, ValueError):
+        return None
+
+
+# Sends a request through the service's rate limiter. Rate limited (429) and failed
+# requests are retried with exponential backoff and jitter, honouring Retry-After.
+# request may return a requests.Response (Canvas) or raise an error carrying the
+# response (TodoistAPI raises httpx.HTTPStatusError). See retry_delay() for the rules
+def call_with_retry(limiter, request, *args, log=print, metrics=None, **kwargs):
+    for attempt in range(max_retries + 1):
+        record_attempt(limiter, metrics, attempt, limiter.acquire())
+        try:
+            result = request(*args, **kwargs)
+        except Exception as error:
+            retry_delay(limiter, attempt, error=error, log=log)
+            continue
+        if retry_delay(limiter, attempt, result, log=log) is None:
+            return result
+
+
+# Records the limiter's wait before an attempt and, after the first, the retry
+def record_attempt(limiter, metrics, attempt, delay):
+    if metrics is not None:
+        if delay > 0:
+            metrics.record_sleep(limiter.name, delay)
+        if attempt > 0:
+            metrics.record_retry(limiter.name)
+
+
+# Decides how an attempt of call_with_retry() or async_call_with_retry() ends, given
+# its result or error. Returns None if the result is final. Errors that are not retried
+# are raised again, and RateLimitExceeded once retries are exhausted. Otherwise the
+# service is paused for the Retry-After or backoff delay, which is logged and returned
+def retry_delay(limiter, attempt, result=None, error=None, log=print):
+    response = None
+    if error is None:
+        if not isinstance(result, (requests.Response, httpx.Response)):
+            return None
+        response = result
+        limiter.observe(response)
+        if not is_retryable(response):
+            return None
+    elif isinstance(
+        error, (requests.ConnectionError, requests.Timeout, httpx.TransportError)
+    ):
+        if attempt == max_retries:
+            raise error
+    else:
+        response = getattr(error, "response", None)
+        if response is None or not is_retryable(response):
+            raise error
+    if attempt == max_retries:
+        raise RateLimitExceeded(
+            f"{limiter.name} API still rate limited after {max_retries} retries"
+        )
+    delay = None if response is None else retry_after(response)
+    if delay is None:
+        delay = min(backoff_max, backoff_base * 2**attempt)
+    delay += uniform(0, delay / 2)
+    log(f"{limiter.name} API rate limited, retrying in {delay:.1f} seconds...")
+    limiter.pause(delay)
+    return delay
+
+
+# Sends a GET request to Canvas through the profile's session and rate limiter. With the
+# Canvas cache, the ETag and Last-Modified of the cached response are sent along and a
+# 304 Not Modified is answered from the cache. A cached response younger than ttl
+# seconds is used without asking Canvas
+def canvas_get(ctx, url, params=None, ttl=None):
+    url, entry, headers, cached = canvas_cache_request(ctx, url, params, ttl)
+    if cached is not None:
+        return cached
+    response = call_with_retry(
+        ctx.canvas_limiter,
+        ctx.canvas_session.get,
+        url,
+        headers=headers,
+        log=ctx.log,
+        metrics=ctx.metrics,
+    )
+    return canvas_cache_response(ctx, url, entry, response, ttl)
+
+
+# Looks up a Canvas GET in the cache. Returns the full URL, the cache entry, the
+# conditional request headers to send, and the cached response if it can be used as is
+def canvas_cache_request(ctx, url, params, ttl):
+    url = requests.Request("GET", url, params=params).prepare().url
+    cache = ctx.canvas_cache
+    if cache is None:
+        return url, None, {}, None
+    entry = cache.get(url)
+    if entry is None:
+        return url, None, {}, None
+    if ttl is not None and time.time() - entry[2] < ttl:
+        ctx.metrics.record_cache(True)
+        cache.touch(url)
+        return url, entry, {}, cached_response(url, entry)
+    headers = {}
+    if entry[0]:
+        headers["If-None-Match"] = entry[0]
+    if entry[1]:
+        headers["If-Modified-Since"] = entry[1]
+    return url, entry, headers, None
+
+
+# Answers a 304 from the cache entry and stores new responses. response may be a
+# requests or an httpx response
+def canvas_cache_response(ctx, url, entry, response, ttl):
+    cache = ctx.canvas_cache
+    if cache is None:
+        return response
+    if response.status_code == 304 and entry is not None:
+        ctx.metrics.record_cache(True)
+        cache.touch(url, validated=True)
+        return cached_response(url, entry)
+    ctx.metrics.record_cache(False)
+    if response.status_code == 200:
+        cache.store(url, response, always=ttl is not None)
+    return response
+
+
+# Builds a response for a cache entry of CanvasCache.get()
+def cached_response(url, entry):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers = CaseInsensitiveDict(json.loads(entry[3]))
+    response.encoding = "utf-8"
+    response._content = entry[4]
+    return response
+
+
+# On-disk cache of Canvas GET responses by URL, with the validators Canvas sent for
+# them. Responses are evicted least recently used first once their bodies add up to
+# more than max_bytes. Shared by the threads that fetch courses in parallel
+class CanvasCache:
+    headers = ("Content-Type", "Link", "ETag", "Last-Modified")  # Headers that are kept
+
+    def __init__(self, path, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                stored_at REAL NOT NULL,
+                headers TEXT NOT NULL,
+                body BLOB NOT NULL,
+                used_at REAL NOT NULL
+            )""")
+        self.db.commit()
+
+    # Returns (etag, last_modified, stored_at, headers, body) of a URL, or None
+    def get(self, url):
+        with self.lock:
+            return self.db.execute(
+                "SELECT etag, last_modified, stored_at, headers, body FROM responses WHERE url = ?",
+                (url,),
+            ).fetchone()
+
+    # Marks a response as used. validated restarts its time to live
+    def touch(self, url, validated=False):
+        now = time.time()
+        with self.lock:
+            if validated:
+                self.db.execute(
+                    "UPDATE responses SET used_at = ?, stored_at = ? WHERE url = ?",
+                    (now, now, url),
+                )
+            else:
+                self.db.execute(
+                    "UPDATE responses SET used_at = ? WHERE url = ?", (now, url)
+                )
+            self.db.commit()
+
+    # Stores a response that carries a validator, or any response when always is set
+    def store(self, url, response, always=False):
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not (etag or last_modified or always):
+            return
+        headers = {
+            name: response.headers[name]
+            for name in self.headers
+            if name in response.headers
+        }
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    etag,
+                    last_modified,
+                    now,
+                    json.dumps(headers),
+                    response.content,
+                    now,
+                ),
+            )
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        size = self.db.execute(
+            "SELECT COALESCE(SUM(LENGTH(body)), 0) FROM responses"
+        ).fetchone()[0]
+        if size <= self.max_bytes:
+            return
+        rows = self.db.execute(
+            "SELECT url, LENGTH(body) FROM responses ORDER BY used_at"
+        ).fetchall()
+        for url, length in rows:
+            if size <= self.max_bytes:
+                break
+            self.db.execute("DELETE FROM responses WHERE url = ?", (url,))
+            size -= length
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+# Calls the Todoist API through the profile's rate limiter
+def todoist_call(ctx, request, *args, **kwargs):
+    return call_with_retry(
+        ctx.todoist_limiter, request, *args, log=ctx.log, metrics=ctx.metrics, **kwargs
+    )
+
+
+# call_with_retry() for the async engine: the request is awaited and may return an
+# httpx.Response or raise an error carrying the response
+async def async_call_with_retry(
+    limiter, request, *args, log=print, metrics=None, **kwargs
+):
+    for attempt in range(max_retries + 1):
+        delay = limiter.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        record_attempt(limiter, metrics, attempt, delay)
+        try:
+            result = await request(*args, **kwargs)
+        except Exception as error:
+            retry_delay(limiter, attempt, error=error, log=log)
+            continue
+        if retry_delay(limiter, attempt, result, log=log) is None:
+            return result
+
+
+# httpx transport that records the requests of the async engine's clients in SyncMetrics
+class AsyncMetricsTransport(httpx.AsyncBaseTransport):
+    def __init__(self, metrics, service, transport=None):
+        self.metrics = metrics
+        self.service = service
+        self.transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request):
+        started = time.perf_counter()
+        response = await self.transport.handle_async_request(request)
+        self.metrics.record_request(
+            self.service,
+            request.method,
+            str(request.url),
+            response.status_code,
+            time.perf_counter() - started,
+        )
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+# Request ids for the TodoistAPIAsync client: the uuid of the operation the current
+# task is sending, if any
+def async_todoist_request_id():
+    return todoist_request_ids.get() or str(uuid.uuid4())
+
+
+# Runs one sync cycle on the async engine
+async def async_sync_cycle(ctx, reload_todoist=True):
+    async with AsyncSyncEngine(ctx) as engine:
+        await engine.sync(reload_todoist)
+
+
+# Async engine used with --async. The Todoist projects and tasks are loaded while the
+# Canvas pages download into a bounded queue, and adds and updates are sent with at
+# most todoist_write_concurrency requests in flight while later pages still arrive.
+# Canvas and Todoist each get a pooled httpx.AsyncClient. Matching, the sync journal
+# and the sync state are shared with the threaded engine, and all of them run on the
+# event loop's thread
+class AsyncSyncEngine:
+    def __init__(self, ctx):
+        self.ctx = ctx
+        config = ctx.config
+        self.workers = max(
+            1, int(config.get("canvas_fetch_workers", canvas_fetch_workers))
+        )
+        self.page_workers = page_workers(ctx)
+        self.canvas = httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {config['canvas_api_key'].strip()}"},
+            timeout=httpx.Timeout(60),
+            transport=AsyncMetricsTransport(
+                ctx.metrics,
+                "Canvas",
+                httpx.AsyncHTTPTransport(
+                    limits=httpx.Limits(
+                        max_connections=self.workers * self.page_workers
+                    )
+                ),
+            ),
+        )
+        self.todoist = httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {config['todoist_api_key'].strip()}"},
+            timeout=httpx.Timeout(60),
+            transport=AsyncMetricsTransport(ctx.metrics, "Todoist"),
+        )
+        self.todoist_api = TodoistAPIAsync(
+            config["todoist_api_key"].strip(),
+            request_id_fn=async_todoist_request_id,
+            client=self.todoist,
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.canvas.aclose()
+        await self.todoist_api.close()
+
+    async def canvas_call(self, request, *args, **kwargs):
+        ctx = self.ctx
+        return await async_call_with_retry(
+            ctx.canvas_limiter,
+            request,
+            *args,
+            log=ctx.log,
+            metrics=ctx.metrics,
+            **kwargs,
+        )
+
+    async def todoist_call(self, request, *args, **kwargs):
+        ctx = self.ctx
+        return await async_call_with_retry(
+            ctx.todoist_limiter,
+            request,
+            *args,
+            log=ctx.log,
+            metrics=ctx.metrics,
+            **kwargs,
+        )
+
+    # Async canvas_get(), through the same Canvas cache
+    async def canvas_get(self, url, params=None):
+        url, entry, headers, cached = canvas_cache_request(self.ctx, url, params, None)
+        if cached is not None:
+            return cached
+        response = await self.canvas_call(self.canvas.get, url, headers=headers)
+        return canvas_cache_response(self.ctx, url, entry, response, None)
+
+    async def sync(self, reload_todoist):
+        ctx = self.ctx
+        metrics = ctx.metrics
+        pages = asyncio.Queue(maxsize=canvas_stream_queue_pages)
+        producer = asyncio.ensure_future(self.produce_canvas_pages(pages))
+        stats = AssignmentStats()
+        try:
+            if reload_todoist:
+                ctx.todoist_project_dict.clear()
+                ctx.todoist_tasks.clear()
+                with metrics.phase("load_todoist_projects"):
+                    await self.load_todoist_projects()
+                with metrics.phase("load_todoist_tasks"):
+                    await self.load_todoist_tasks()
+                with metrics.phase("build_todoist_task_index"):
+                    build_todoist_task_index(ctx)
+            with metrics.phase("create_todoist_projects"):
+                await self.create_todoist_projects()
+            with metrics.phase("stream_assignments_to_todoist"):
+                await self.transfer(pages, stats)
+        finally:
+            producer.cancel()
+            with suppress(asyncio.CancelledError):
+                await producer
+        canvas_assignment_stats(ctx, stats)
+
+    async def load_todoist_projects(self):
+        ctx = self.ctx
+        if ctx.config.get("todoist_incremental_sync", False):
+            response = await self.todoist_call(
+                self.todoist.post,
+                ctx.config.get("todoist_sync_url", todoist_sync_url),
+                data=todoist_cache_sync_params(ctx),
+            )
+            response.raise_for_status()
+            apply_todoist_sync(ctx, response.json())
+            load_cached_todoist_projects(ctx)
+        else:
+            pages = await self.todoist_api.get_projects()
+            while (page := await self.todoist_call(anext, pages, None)) is not None:
+                for project in page:
+                    ctx.todoist_project_dict[project.name] = project.id
+        ctx.log(f"Loaded {len(ctx.todoist_project_dict)} Todoist Projects")
+
+    # The requests for each filter of todoist_task_scope are sent concurrently
+    async def load_todoist_tasks(self):
+        ctx = self.ctx
+        if ctx.config.get("todoist_incremental_sync", False):
+            load_todoist_tasks(ctx)  # Reads the local copy, no requests
+            return
+
+        async def load(task_filter):
+            pages = await self.todoist_api.get_tasks(**task_filter)
+            while (page := await self.todoist_call(anext, pages, None)) is not None:
+                ctx.todoist_tasks.extend(todoist_task(task) for task in page)
+
+        await asyncio.gather(*(load(f) for f in todoist_task_filters(ctx)))
+        ctx.log(f"Loaded {len(ctx.todoist_tasks)} Todoist Tasks")
+
+    async def create_todoist_projects(self):
+        for course_name in missing_todoist_projects(self.ctx):
+            project = await self.todoist_call(self.todoist_api.add_project, course_name)
+            todoist_project_created(self.ctx, project)
+
+    # Puts pages of assignments into the queue, then None when all are loaded. An error
+    # is put into the queue in place of None
+    async def produce_canvas_pages(self, pages):
+        ctx = self.ctx
+        try:
+            if canvas_fetch_backend(ctx) == "graphql":
+                try:
+                    source = self.graphql_pages()
+                    first = await anext(source, None)
+                except CanvasGraphQLError as error:
+                    ctx.log(
+                        f"Canvas GraphQL API unavailable ({error}), falling back to REST"
+                    )
+                    ctx.graphql_unavailable = True
+                else:
+                    if first is not None:
+                        await pages.put(first)
+                    async for page in source:
+                        await pages.put(page)
+                    await pages.put(None)
+                    return
+            courses = asyncio.Semaphore(self.workers)
+
+            async def produce(course_id):
+                async with courses:
+                    async for page in self.course_pages(course_id):
+                        await pages.put(page)
+
+            await asyncio.gather(*(produce(c) for c in ctx.course_ids))
+            await pages.put(None)
+        except Exception as error:
+            await pages.put(error)
+
+    # Async iter_course_assignment_pages()
+    async def course_pages(self, course_id):
+        pager = CourseAssignmentPager(self.ctx, course_id)
+        response = await self.canvas_get(pager.first_url(), params=param)
+        yield pager.page(response, first=True)
+        urls = pager.numbered_urls(response)
+        if urls:
+            in_flight = asyncio.Semaphore(self.page_workers)
+
+            async def get(url):
+                async with in_flight:
+                    return await self.canvas_get(url)
+
+            fetches = [asyncio.ensure_future(get(url)) for url in urls]
+            try:
+                for request in fetches:
+                    response = await request
+                    yield pager.page(response)
+            finally:
+                for request in fetches:
+                    request.cancel()
+        while (url := pager.next_url(response)) is not None:
+            response = await self.canvas_get(url)
+            yield pager.page(response)
+        pager.finish()
+
+    # Async iter_graphql_assignment_pages()
+    async def graphql_pages(self):
+        pager = GraphQLPager(self.ctx)
+        for course_ids, query in pager.requests():
+            try:
+                response = await self.canvas_call(
+                    self.canvas.post, pager.url(), json=query
+                )
+                response.raise_for_status()
+                result = response.json()
+            except (httpx.HTTPError, ValueError) as error:
+                raise CanvasGraphQLError(error)
+            yield pager.page(result, course_ids)
+
+    # Async transfer_assignments_to_todoist(), planning and executing each page of
+    # assignments as it arrives
+    async def transfer(self, pages, stats):
+        ctx = self.ctx
+        counts = sync_counts()
+        writer = AsyncTodoistWriter(self)
+        planned = [] if ctx.dry_run else None  # Assignments for print_sync_plan()
+        try:
+            journal = [] if ctx.dry_run else load_sync_journal(ctx)
+            if journal:
+                ctx.log(f"Resuming {len(journal)} Todoist writes left by the last run")
+                execute_sync_plan(ctx, journal, writer, counts)
+                await writer.drain()
+            synced_state = load_sync_state(ctx)
+            rules = compile_exclusion_rules(ctx)
+            resumed = {operation["assignment_id"] for operation in journal}
+            while not ctx.limit_reached:
+                page = await pages.get()
+                if page is None:
+                    ctx.log(f"Loaded {stats.total} Total Canvas Assignments")
+                    break
+                if isinstance(page, SyncError):
+                    raise page
+                if isinstance(page, Exception):
+                    raise SyncError(
+                        f"Error while loading Assignments: {page}\nCheck or regenerate API Key and Canvas URL"
+                    )
+                for assignment in page:
+                    stats.add(assignment)
+                if planned is not None:
+                    planned.extend(page)
+                    continue
+                execute_sync_plan(
+                    ctx,
+                    plan_sync(ctx, page, counts, synced_state, rules, resumed),
+                    writer,
+                    counts,
+                )
+        finally:
+            await writer.drain()
+            counts["failed"] += len(writer.failed)
+            ctx.sync_state.commit()
+        if planned is not None:
+            print_sync_plan(ctx, planned, counts)
+        else:
+            finish_transfer(ctx, counts)
+
+
+# TodoistBatchWriter for the async engine. Full batches (or single REST writes when
+# todoist_batch_writes is false) are sent as tasks on the event loop, with at most
+# todoist_write_concurrency requests in flight. Writes that have not been sent when the
+# rate limit is reached stay in the journal
+class AsyncTodoistWriter(TodoistBatchWriter):
+    def __init__(self, engine, batch_size=todoist_batch_size):
+        super().__init__(engine.ctx, batch_size)
+        self.engine = engine
+        self.batch_writes = engine.ctx.config.get("todoist_batch_writes", True)
+        self.requests = asyncio.Semaphore(
+            int(
+                engine.ctx.config.get(
+                    "todoist_write_concurrency", todoist_write_concurrency
+                )
+            )
+        )
+        self.tasks = set()
+
+    def queue(self, operation, on_success):
+        if self.batch_writes:
+            super().queue(operation, on_success)
+        else:
+            self.spawn(self.send_operation(operation, on_success))
+
+    def flush(self):
+        if self.pending:
+            batch, self.pending = self.pending, []
+            self.spawn(self.send_batch(batch))
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    # Sends what is pending and waits until every write has been answered
+    async def drain(self):
+        self.flush()
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks))
+
+    async def send_batch(self, batch):
+        ctx = self.ctx
+        async with self.requests:
+            if ctx.limit_reached:
+                return
+            ctx.sync_state.commit()  # The journal must hold every command that is sent
+            try:
+                response = await self.engine.todoist_call(
+                    self.engine.todoist.post,
+                    ctx.config.get("todoist_sync_url", todoist_sync_url),
+                    data={
+                        "commands": json.dumps(
+                            [sync_command(operation) for operation, _ in batch]
+                        )
+                    },
+                )
+                response.raise_for_status()
+                result = response.json()
+            except RateLimitExceeded as error:
+                ctx.log(
+                    f"Error while sending tasks to Todoist: {error}. Try again in 15 minutes"
+                )
+                ctx.limit_reached = True
+                return
+            except Exception as error:
+                ctx.log(f"Error while sending tasks to Todoist: {error}")
+                for operation, _ in batch:
+                    self.fail(operation, str(error))
+                return
+            self.apply_result(batch, result)
+
+    # Async send_operation(), with the operation's uuid as the X-Request-Id
+    async def send_operation(self, operation, on_success):
+        ctx = self.ctx
+        api = self.engine.todoist_api
+        async with self.requests:
+            if ctx.limit_reached:
+                return
+            ctx.sync_state.commit()
+            args = operation["args"]
+            due_datetime, deadline_date = rest_due_fields(args)
+            request_id = todoist_request_ids.set(operation["uuid"])
+            try:
+                if operation["action"] == "add":
+                    task = await self.engine.todoist_call(
+                        api.add_task,
+                        content=args["content"],
+                        project_id=args["project_id"],
+                        due_datetime=due_datetime,
+                        deadline_date=deadline_date,
+                        labels=args["labels"],
+                        priority=args["priority"],
+                    )
+                    on_success(task.id)
+                else:
+                    await self.engine.todoist_call(
+                        api.update_task,
+                        task_id=args["id"],
+                        due_datetime=due_datetime,
+                        deadline_date=deadline_date,
+                    )
+                    on_success(args["id"])
+            except RateLimitExceeded as error:
+                ctx.log(f"Error while sending task: {error}. Try again in 15 minutes")
+                ctx.limit_reached = True
+            except Exception as error:
+                ctx.log(f"Error while sending task {operation['name']}: {error}")
+                self.fail(operation, str(error))
+            finally:
+                todoist_request_ids.reset(request_id)
 
 
 if __name__ == "__main__":